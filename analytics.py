@@ -0,0 +1,261 @@
+import functools
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from flask import current_app, request
+
+import db
+
+# 0 records nothing; the stats endpoints still read the rollups
+ENABLED = os.environ.get('MAWATER_ANALYTICS', '1') == '1'
+# How often buffered counts are added to the rollups. 0 leaves flushing to
+# whoever calls flush() (tests, the benchmark).
+FLUSH_INTERVAL = float(os.environ.get('MAWATER_ANALYTICS_FLUSH_SECONDS', '5'))
+SHARDS = int(os.environ.get('MAWATER_ANALYTICS_SHARDS', '16'))
+# Distinct (car, day) keys a shard buffers between flushes; counts for new
+# keys beyond this are dropped rather than growing without bound
+MAX_KEYS_PER_SHARD = 50000
+
+# Positions in a buffered [views, impressions] pair
+VIEW = 0
+IMPRESSION = 1
+
+# Days are UTC dates, like CURRENT_TIMESTAMP. Cars deleted since the counts
+# were buffered match no row and are skipped.
+ROLLUP_SQL = '''
+    INSERT INTO car_daily_stats (car_id, day, views, impressions)
+    SELECT id, ?, ?, ? FROM cars WHERE id = ?
+    ON CONFLICT (car_id, day) DO UPDATE SET
+        views = views + excluded.views,
+        impressions = impressions + excluded.impressions
+'''
+VIEW_COUNT_SQL = 'UPDATE cars SET view_count = view_count + ? WHERE id = ?'
+# The seller's /api/my-cars shows view_count, so its ETag has to move; the
+# car page and listings keep theirs and show the count as of their version
+SELLER_VERSION_SQL = '''
+    INSERT INTO resource_versions (resource, scope_id, version)
+    SELECT DISTINCT 'my-cars', user_id, 1 FROM cars
+    WHERE id IN (SELECT value FROM json_each(?)) AND user_id IS NOT NULL
+    ON CONFLICT (resource, scope_id) DO UPDATE SET version = version + 1
+'''
+
+
+def _today():
+    return time.strftime('%Y-%m-%d', time.gmtime())
+
+
+class _Shard:
+    __slots__ = ('lock', 'counts', 'dropped')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}    # (car_id, day) -> [views, impressions]
+        self.dropped = 0
+
+
+class ViewCounter:
+    # Counts car page views and search impressions in memory and adds them
+    # to the car_daily_stats rollup (and cars.view_count) in one transaction
+    # per flush interval, so a page view costs a dict update instead of a
+    # write. Each request thread sticks to one of several shards, so threads
+    # rarely wait on each other's lock; a flush swaps every shard's dict out
+    # and merges them. Counts still buffered when a process dies are lost.
+
+    def __init__(self, enabled=ENABLED, flush_interval=FLUSH_INTERVAL, shards=SHARDS,
+                 max_keys=MAX_KEYS_PER_SHARD):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self._shards = [_Shard() for _ in range(shards)]
+        self._next_shard = itertools.count()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn = None
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.flushed_rows = 0
+        self.flushed_views = 0
+        self.flushed_impressions = 0
+        self._flush_time = 0.0
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = self._shards[next(self._next_shard) % len(self._shards)]
+        return shard
+
+    def _start(self):
+        # Started on first use, so a server forking workers after import
+        # gets one flusher per worker
+        with self._lock:
+            if self._thread is None and not self._stop.is_set():
+                self._thread = threading.Thread(target=self._run, name='view-counter', daemon=True)
+                self._thread.start()
+
+    def record(self, car_id, kind=VIEW):
+        self.record_many((car_id,), kind)
+
+    def record_many(self, car_ids, kind=VIEW):
+        if not self.enabled:
+            return
+        if self._thread is None and self.flush_interval > 0:
+            self._start()
+        day = _today()
+        shard = self._shard()
+        with shard.lock:
+            counts = shard.counts
+            for car_id in car_ids:
+                entry = counts.get((car_id, day))
+                if entry is None:
+                    if len(counts) >= self.max_keys:
+                        shard.dropped += 1
+                        continue
+                    entry = counts[(car_id, day)] = [0, 0]
+                entry[kind] += 1
+
+    def counts_views(self, argument):
+        # Counts a GET answered with the car (200) or with the client's still
+        # current copy (304); the car id is the view argument named here
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                response = current_app.make_response(view(*args, **kwargs))
+                if request.method == 'GET' and response.status_code in (200, 304):
+                    self.record(kwargs[argument])
+                return response
+            return wrapper
+        return decorator
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _take(self):
+        merged = {}
+        for shard in self._shards:
+            with shard.lock:
+                counts, shard.counts = shard.counts, {}
+            for key, (views, impressions) in counts.items():
+                entry = merged.get(key)
+                if entry is None:
+                    merged[key] = [views, impressions]
+                else:
+                    entry[VIEW] += views
+                    entry[IMPRESSION] += impressions
+        return merged
+
+    def _restore(self, merged):
+        # A failed flush keeps its counts for the next one
+        shard = self._shards[0]
+        with shard.lock:
+            for key, (views, impressions) in merged.items():
+                entry = shard.counts.setdefault(key, [0, 0])
+                entry[VIEW] += views
+                entry[IMPRESSION] += impressions
+
+    def flush(self):
+        # Adds everything buffered so far to the rollups; returns the number
+        # of (car, day) rows written
+        with self._flush_lock:
+            merged = self._take()
+            if not merged:
+                return 0
+            start = time.perf_counter()
+            try:
+                if self._conn is None:
+                    self._conn = db.connect()
+                conn = self._conn
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.executemany(ROLLUP_SQL, [(day, views, impressions, car_id)
+                                                  for (car_id, day), (views, impressions) in merged.items()])
+                    views_by_car = {}
+                    for (car_id, _), (views, _) in merged.items():
+                        if views:
+                            views_by_car[car_id] = views_by_car.get(car_id, 0) + views
+                    conn.executemany(VIEW_COUNT_SQL, [(views, car_id) for car_id, views in views_by_car.items()])
+                    if views_by_car:
+                        conn.execute(SELLER_VERSION_SQL, (json.dumps(list(views_by_car)),))
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
+            except Exception as e:
+                print(f"Error flushing {len(merged)} view counts: {str(e)}")
+                self._restore(merged)
+                with self._lock:
+                    self.failed_flushes += 1
+                return 0
+            with self._lock:
+                self.flushes += 1
+                self.flushed_rows += len(merged)
+                self.flushed_views += sum(views for views, _ in merged.values())
+                self.flushed_impressions += sum(impressions for _, impressions in merged.values())
+                self._flush_time += time.perf_counter() - start
+            return len(merged)
+
+    def close(self):
+        # Stops the flusher and writes what is still buffered
+        self._stop.set()
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join(max(self.flush_interval, 1))
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def stats(self):
+        pending = 0
+        dropped = 0
+        for shard in self._shards:
+            with shard.lock:
+                pending += len(shard.counts)
+                dropped += shard.dropped
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'flush_interval_seconds': self.flush_interval,
+                'shards': len(self._shards),
+                'pending_rows': pending,
+                'dropped': dropped,
+                'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+                'flushed_rows': self.flushed_rows,
+                'flushed_views': self.flushed_views,
+                'flushed_impressions': self.flushed_impressions,
+                'avg_flush_ms': round(self._flush_time * 1000 / self.flushes, 3) if self.flushes else 0.0,
+            }
+
+
+def benchmark(threads=(1, 4, 16), records=200000, cars=10000):
+    # Views recorded per second by 1..n threads into a counter that never
+    # flushes, against the same number of plain dict increments under one lock
+    results = []
+    for count in threads:
+        per_thread = records // count
+        for name, make in (('sharded', lambda: ViewCounter(enabled=True, flush_interval=0)),
+                           ('single lock', lambda: ViewCounter(enabled=True, flush_interval=0, shards=1))):
+            counter = make()
+
+            def work(offset):
+                for i in range(per_thread):
+                    counter.record((offset + i) % cars)
+
+            workers = [threading.Thread(target=work, args=(n * 7919,)) for n in range(count)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            results.append((count, name, per_thread * count / elapsed))
+    return results
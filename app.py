@@ -1,82 +1,384 @@
-from flask import Flask, request, jsonify
+from flask import Flask, g, request, jsonify, send_from_directory, url_for
 from flask_cors import CORS
+import atexit
+import click
 import sqlite3
 import os
+import re
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
+
+import analytics
+import auth
+import bulk
+import db
+import facets
+import loadtest
+import metrics
+import httpcache
+import migrations
+import passwords
+import projection
+import search
+import writequeue
+import photos
+from cache import ResultCache
+from db import get_db
+from events import MessageHub, StreamLimitReached, format_event
+from httpcache import conditional_get
+from pagination import decode_cursor, encode_cursor, parse_limit
 
 app = Flask(__name__)
+# Multipart file fields stream to the photo store while they are parsed
+app.request_class = photos.UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = photos.MAX_UPLOAD_BYTES
 CORS(app)
+db.init_app(app)
+metrics.init_app(app)
+auth.init_app(app)
+httpcache.init_app(app)
+# Bumped with the response shape (list endpoints default to card fields,
+# facets have no total, photo URLs are paths)
+app.config['ETAG_SALT'] = f'schema-{migrations.MIGRATIONS[-1][0]}-photo-paths'
 
 def init_db():
-    # Delete existing database if it exists
-    if os.path.exists('mawater.db'):
-        os.remove('mawater.db')
-    
-    conn = sqlite3.connect('mawater.db')
+    # Bring the schema up to date without touching existing data
+    conn = db.connect()
+    try:
+        applied = migrations.migrate(conn)
+    finally:
+        conn.close()
+    for version, description in applied:
+        print(f"Applied migration {version}: {description}")
+    print(f"Database ready at schema version {migrations.MIGRATIONS[-1][0]}")
+
+def create_app(migrate=None):
+    # Entry point for servers (wsgi.py) and `flask --app app:create_app run`.
+    # Importing this module leaves the database alone; the schema is brought
+    # up to date here, and migrate() is safe to run from several processes.
+    if migrate is None:
+        migrate = os.environ.get('MAWATER_MIGRATE_ON_START', '1') == '1'
+    if migrate:
+        init_db()
+    if not app.config.get('SHUTDOWN_REGISTERED'):
+        app.config['SHUTDOWN_REGISTERED'] = True
+        atexit.register(shutdown)
+    return app
+
+def shutdown():
+    # Graceful stop: fail readiness so the load balancer drains this process,
+    # end open message streams, write buffered view counts, finish queued
+    # thumbnails, stop the password hashing processes and close pooled
+    # connections
+    if app.config.get('SHUTTING_DOWN'):
+        return
+    app.config['SHUTTING_DOWN'] = True
+    message_hub.close()
+    write_queue.close()
+    view_counter.close()
+    thumbnail_worker.shutdown()
+    passwords.pool.shutdown()
+    db.pool.close_all()
+    db.read_pool.close_all()
+    if db.snapshot is not None:
+        db.snapshot.close()
+
+@app.cli.command('migrate')
+def migrate_command():
+    init_db()
+
+@app.cli.command('backfill-conversations')
+def backfill_conversations_command():
+    conn = db.connect()
+    try:
+        count = migrations.backfill_conversations(conn)
+    finally:
+        conn.close()
+    print(f"Rebuilt {count} conversation summaries")
+
+@app.cli.command('reconcile-counters')
+@click.option('--batch-size', default=migrations.RECONCILE_BATCH_SIZE, show_default=True)
+def reconcile_counters_command(batch_size):
+    # Repairs favorite counts that drifted from the favorites table
+    conn = db.connect()
+    try:
+        count = migrations.reconcile_favorite_counts(conn, batch_size)
+    finally:
+        conn.close()
+    print(f"Repaired {count} favorite counts")
+
+@app.cli.command('bench-views')
+@click.option('--requests', 'count', default=2000, help='Car page requests per run')
+@click.option('--concurrency', default=8)
+def bench_views_command(count, concurrency):
+    # The car page with view counting off and on, then the cost of recording
+    conn = db.connect()
+    try:
+        ctx = loadtest.Context(conn)
+    finally:
+        conn.close()
+    enabled = view_counter.enabled
+    try:
+        for counting in (False, True):
+            view_counter.enabled = counting
+            result = loadtest.run(app, ctx, ['car: detail'], count, concurrency, progress=lambda line: None)
+            print(loadtest.format_result(f"views {'on' if counting else 'off'}", result['car: detail']))
+    finally:
+        view_counter.enabled = enabled
+    view_counter.flush()
+    for threads, name, per_second in analytics.benchmark():
+        print(f"{threads:3} threads {name:12} {per_second:12.0f} views recorded/s")
+
+@app.cli.command('bench-passwords')
+def bench_passwords_command():
+    print(f"Current method: {passwords.PASSWORD_METHOD}, {passwords.HASH_WORKERS} hash workers")
+    for method, ms, per_second in passwords.benchmark():
+        print(f"{method:24} {ms:8.1f} ms/login {per_second:8.1f} logins/s per core "
+              f"{per_second * max(passwords.HASH_WORKERS, 1):8.1f} logins/s with the pool")
+
+@app.cli.command('bench-serialization')
+def bench_serialization_command():
+    print(f"Fast encoder: {'orjson' if projection.orjson else 'json (compact)'}")
+    for fields, encoder, size, ms in projection.benchmark(app):
+        print(f"{fields:5} {encoder:9} {size:9} bytes/1000 rows {ms:8.2f} ms/1000 rows")
+
+@app.cli.command('seed-benchmark')
+@click.argument('path')
+@click.option('--users', default=loadtest.DEFAULT_SIZES['users'])
+@click.option('--cars', default=loadtest.DEFAULT_SIZES['cars'])
+@click.option('--messages', default=loadtest.DEFAULT_SIZES['messages'])
+@click.option('--favorites', default=loadtest.DEFAULT_SIZES['favorites'])
+@click.option('--seed', 'seed_value', default=0)
+def seed_benchmark_command(path, users, cars, messages, favorites, seed_value):
+    # Writes a new database; point MAWATER_DB at it to run the load test
+    sizes = {'users': users, 'cars': cars, 'messages': messages, 'favorites': favorites}
+    try:
+        loadtest.seed(path, sizes, seed_value)
+    except FileExistsError as e:
+        raise click.ClickException(str(e))
+    print(f"Seeded {path}")
+
+@app.cli.command('loadtest')
+@click.option('--requests', 'count', default=200, help='Requests per endpoint')
+@click.option('--concurrency', default=8)
+@click.option('--url', default=None, help='Base URL of a running server (same MAWATER_SECRET_KEY); '
+                                          'defaults to the in-process test client')
+@click.option('--endpoint', 'endpoints', multiple=True, type=click.Choice(list(loadtest.SCENARIOS)))
+@click.option('--seed', 'seed_value', default=0)
+@click.option('--out', default=None, help='Write the results as JSON')
+@click.option('--compare', 'previous', default=None, help='Earlier results JSON to compare against')
+def loadtest_command(count, concurrency, url, endpoints, seed_value, out, previous):
+    conn = db.connect()
+    try:
+        ctx = loadtest.Context(conn, seed_value=seed_value)
+        dataset = loadtest.dataset_counts(conn)
+    finally:
+        conn.close()
+    print(f"Dataset: {dataset}; {count} requests per endpoint at concurrency {concurrency}")
+    results = loadtest.run(app, ctx, endpoints or None, count, concurrency, url, seed_value,
+                           token_for=auth.issue_token)
+    data = loadtest.report(results, dataset, concurrency, count, url or 'test-client')
+    if previous:
+        for line in loadtest.compare(loadtest.load(previous), data):
+            print(line)
+    if out:
+        loadtest.save(data, out)
+        print(f"Results written to {out}")
+
+def listing_plan_checks():
+    # /api/cars and /api/cars/facets statements, built the way the routes
+    # build them: every sort key on a second page, then filtered, favorite
+    # and full-text searches with their counts and facets
+    columns = projection.select_list(projection.CARD_FIELDS, 'cars', photos_column('cars.id'))
+    position = {'v': 2015, 'id': 100}
+    filters = {'make': 'Toyota', 'model': 'Corolla', 'year_min': 2010, 'price_max': 20000.0}
+    fts_query = build_fts_query('toy')
+    checks = [(f'cars: next page by {sort_by}',
+               *search.page_query({}, sort_by, 'DESC', columns, 20, position=position))
+              for sort_by in search.SORT_KEYS if sort_by != 'relevance']
+    checks += [
+        ('cars: filtered', *search.page_query(filters, 'created_at', 'DESC', columns, 20)),
+        ('cars: filtered count', *search.count_query(filters)),
+        ('cars: with favorites', *search.page_query(filters, 'price', 'ASC', columns, 20, favorites_for=1)),
+        ('cars: full-text search', *search.page_query(filters, 'relevance', 'ASC', columns, 20, fts_query)),
+        ('cars: full-text count', *search.count_query(filters, fts_query)),
+        ('facets', *facets.facet_query(filters)),
+        ('facets: full-text', *facets.facet_query(filters, fts_query)),
+    ]
+    return checks
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    checks = migrations.QUERY_PLAN_CHECKS + listing_plan_checks()
+    conn = db.connect()
+    try:
+        failures = migrations.check_query_plans(conn, checks)
+    finally:
+        conn.close()
+    for name, scans in failures:
+        print(f"FULL SCAN in {name}: {'; '.join(scans)}")
+    if failures:
+        raise SystemExit(1)
+    print(f"All {len(checks)} route queries use an index")
+
+COUNTER_FIELDS = ('favorite_count', 'view_count')
+
+def counters_requested():
+    # Scope of the 'car-counters' version for listings that sort by or show
+    # favorite counts, None for the rest
+    fields = request.args.get('fields') or ''
+    names = {name.strip() for name in fields.split(',')}
+    if request.args.get('sort_by') == 'popularity' or names & {'all', 'favorite_count'}:
+        return 0
+    return None
+
+# Public listing searches, cached as serialized response bodies keyed by the
+# normalized filters, sort and page and by the resource versions the ETag is
+# built from. A write through any worker process bumps those versions, so it
+# moves later searches to new keys; the old entries age out by TTL and LRU.
+listing_cache = ResultCache()
+
+# Wakes a user's open /api/messages/stream connections after a write
+message_hub = MessageHub()
+STREAM_BATCH_SIZE = 100
+
+MAX_FAVORITE_CHECK_IDS = 200
+
+MODERATION_STATUSES = ('pending', 'approved', 'rejected')
+MAX_MODERATION_BATCH = 1000
+
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 200
+MAX_MESSAGE_ID = 2 ** 63 - 1
+
+# Small high-frequency writes (favorites, messages, read receipts) are
+# group-committed by one writer thread
+write_queue = writequeue.WriteQueue()
+
+# Car page views and search impressions, counted in memory and rolled up
+# per car and day in the background
+view_counter = analytics.ViewCounter()
+MAX_IMPRESSION_IDS = 200
+MAX_STATS_DAYS = 365
+
+@app.before_request
+def read_your_writes():
+    # A user's reads wait until the writes they queued have committed
+    if request.method == 'GET':
+        write_queue.wait_for(auth.claimed_user_id())
+        write_queue.wait_for(request.args.get('include_favorites_for', type=int))
+
+def principal_id():
+    # Scope of the signed-in user's own copy of a resource
+    return auth.current_principal().id
+
+def notify_users(*user_ids):
+    ids = []
+    for user_id in user_ids:
+        try:
+            ids.append(int(user_id))
+        except (TypeError, ValueError):
+            pass
+    message_hub.publish(*ids)
+
+def message_to_dict(row):
+    # Row shape: m.*, sender first/last name, receiver first/last name
+    return {
+        'id': row[0],
+        'sender_id': row[1],
+        'receiver_id': row[2],
+        'car_id': row[3],
+        'message': row[4],
+        'read': row[5],
+        'created_at': row[6],
+        'sender_name': f"{row[7]} {row[8]}",
+        'receiver_name': f"{row[9]} {row[10]}"
+    }
+
+# Resizes uploaded photos in the background
+thumbnail_worker = photos.ThumbnailWorker()
+
+def photos_column(car_id):
+    # A car's photo names as one comma-separated column, read alongside the
+    # car rows through the (car_id, position) index
+    return f"""(SELECT group_concat(photo_path, ',') FROM (
+        SELECT photo_path FROM car_photos WHERE car_id = {car_id}
+        ORDER BY position, id))"""
+
+def photo_urls(names, thumbnails=True):
+    # Paths, not absolute URLs: listing bodies are cached and ETagged without
+    # regard to the Host they were requested through
+    endpoint = 'photo_thumbnail' if thumbnails else 'photo'
+    return [url_for(endpoint, name=name)
+            for name in (names or '').split(',') if name]
+
+ADMIN_CAR_FIELDS = tuple(field for field in projection.CAR_FIELDS if field != 'photos')
+MY_CAR_FIELDS = tuple(field for field in projection.CAR_FIELDS if field != 'user_id')
+# A user's favorites are versioned per user, not per car, so they leave out
+# the counters that change with other users' clicks
+FAVORITE_FIELDS = tuple(field for field in projection.CAR_FIELDS if field not in COUNTER_FIELDS)
+
+def project_car(fields, row):
+    # Row shape: the projected fields in order, then anything the query added
+    car = dict(zip(fields, row))
+    if 'photos' in car:
+        car['photos'] = photo_urls(car['photos'])
+    return car
+
+def save_photos(conn, car_id, uploads):
+    # Stores the uploads and appends them to the car's photos; the caller
+    # commits. Thumbnails depend only on the file content, so they can be
+    # queued straight away.
     c = conn.cursor()
+    c.execute("SELECT COUNT(*), IFNULL(MAX(position) + 1, 0) FROM car_photos WHERE car_id = ?",
+              (car_id,))
+    count, position = c.fetchone()
+    if count + len(uploads) > photos.MAX_PHOTOS_PER_CAR:
+        raise photos.InvalidPhoto(f'At most {photos.MAX_PHOTOS_PER_CAR} photos per car')
+    names = [photos.store_upload(upload) for upload in uploads]
+    c.executemany("INSERT INTO car_photos (car_id, photo_path, position) VALUES (?, ?, ?)",
+                  [(car_id, name, position + i) for i, name in enumerate(names)])
+    for name in names:
+        thumbnail_worker.submit(name)
+    return names
+
+# Columns written when a seller lists a car, in the order car_values()
+# returns them followed by the owner and status
+CAR_INSERT_COLUMNS = ('make', 'model', 'year', 'price', 'mileage', 'condition', 'description',
+                      'user_id', 'status')
+
+def car_values(data):
+    # Type coercion and validation for a new listing, shared by POST /api/cars
+    # and bulk import. Raises ValueError with the message for the client.
+    try:
+        year = int(data.get('year', 0))
+        price = float(data.get('price', 0))
+        mileage = int(data.get('mileage', 0)) if data.get('mileage') else None
+    except (ValueError, TypeError):
+        raise ValueError('Invalid data types. Year and price must be numbers.')
     
-    # Create users table
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  firstName TEXT NOT NULL,
-                  lastName TEXT NOT NULL,
-                  email TEXT UNIQUE NOT NULL,
-                  password TEXT NOT NULL,
-                  phone TEXT,
-                  is_admin INTEGER DEFAULT 0)''')
-    
-    # Create cars table with approval status
-    c.execute('''CREATE TABLE IF NOT EXISTS cars
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  make TEXT NOT NULL,
-                  model TEXT NOT NULL,
-                  year INTEGER NOT NULL,
-                  price REAL NOT NULL,
-                  mileage INTEGER,
-                  condition TEXT,
-                  description TEXT,
-                  user_id INTEGER,
-                  status TEXT DEFAULT 'pending',
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users (id))''')
-    
-    # Create favorites table
-    c.execute('''CREATE TABLE IF NOT EXISTS favorites
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER NOT NULL,
-                  car_id INTEGER NOT NULL,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users (id),
-                  FOREIGN KEY (car_id) REFERENCES cars (id),
-                  UNIQUE(user_id, car_id))''')
-    
-    # Create messages table
-    c.execute('''CREATE TABLE IF NOT EXISTS messages
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  sender_id INTEGER NOT NULL,
-                  receiver_id INTEGER NOT NULL,
-                  car_id INTEGER,
-                  message TEXT NOT NULL,
-                  read INTEGER DEFAULT 0,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (sender_id) REFERENCES users (id),
-                  FOREIGN KEY (receiver_id) REFERENCES users (id),
-                  FOREIGN KEY (car_id) REFERENCES cars (id))''')
-    
-    # Create default admin user and test user
-    c.execute("INSERT INTO users (firstName, lastName, email, password, is_admin) VALUES (?, ?, ?, ?, ?)",
-             ('Admin', 'User', 'admin@mawater974.com', 'admin', 1))
-    
-    c.execute("INSERT INTO users (firstName, lastName, email, password, is_admin) VALUES (?, ?, ?, ?, ?)",
-             ('Duda', 'User', 'dudaduda336@gmail.com', 'duda123', 0))
-    
-    conn.commit()
-    conn.close()
-    print("Database initialized with admin user and test user")
-
-# Initialize database
-init_db()
+    # Validate required fields
+    if not all([data.get('make'), data.get('model'), year > 0, price > 0]):
+        raise ValueError('Make, model, year, and price are required')
+    return (data.get('make'), data.get('model'), year, price, mileage,
+            data.get('condition'), data.get('description'))
+
+# Appended to UPDATE/DELETE/SELECT on cars with (user id, is_admin) params
+# so the ownership check runs in the same statement as the write
+OWNED_BY = "(user_id = ? OR ?)"
+
+def car_write_refused(c, car_id):
+    # Only reached when a conditional write matched nothing
+    c.execute("SELECT 1 FROM cars WHERE id = ?", (car_id,))
+    if not c.fetchone():
+        return jsonify({'error': 'Car not found'}), 404
+    return jsonify({'error': 'Unauthorized'}), 403
+
+def build_fts_query(q):
+    # Every word must match, each as a prefix ("toy cor" finds Toyota
+    # Corolla). Words are quoted so FTS5 operators in user input are inert.
+    terms = re.findall(r'\w+', q)
+    return ' '.join(f'"{term}"*' for term in terms)
 
 @app.route('/api/login', methods=['POST'])
 def login():
@@ -87,30 +389,40 @@ def login():
     if not email or not password:
         return jsonify({'error': 'Email and password are required'}), 400
     
-    conn = sqlite3.connect('mawater.db')
-    c = conn.cursor()
-    
     try:
-        c.execute("SELECT * FROM users WHERE email = ? AND password = ?", (email, password))
-        user = c.fetchone()
+        # Hashing takes far longer than the queries, so a pooled connection
+        # is only held for the lookup and for the rehash write
+        with db.pooled_connection() as conn:
+            user = conn.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
         
-        if user:
+        if user and passwords.verify_password(user[4], password):
+            # Upgrade plaintext or outdated hashes now that we know the password
+            if passwords.needs_rehash(user[4]):
+                new_hash = passwords.hash_password(password)
+                with db.pooled_connection() as conn:
+                    conn.execute("UPDATE users SET password = ? WHERE id = ? AND password = ?",
+                                 (new_hash, user[0], user[4]))
+                    conn.commit()
             return jsonify({
                 'id': user[0],
                 'firstName': user[1],
                 'lastName': user[2],
                 'email': user[3],
                 'phone': user[5],
-                'is_admin': bool(user[6])
+                'is_admin': bool(user[6]),
+                'token': auth.issue_token(user[0])
             })
         else:
             return jsonify({'error': 'Invalid email or password'}), 401
             
+    except passwords.HashingBusy as e:
+        return jsonify({'error': str(e)}), 503
+    except db.PoolTimeout:
+        # Answered by its error handler with a 503
+        raise
     except Exception as e:
         print(f"Error during login: {str(e)}")
         return jsonify({'error': str(e)}), 400
-    finally:
-        conn.close()
 
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -124,169 +436,162 @@ def register():
     if not all([firstName, lastName, email, password]):
         return jsonify({'error': 'All fields are required'}), 400
     
-    conn = sqlite3.connect('mawater.db')
-    c = conn.cursor()
-    
     try:
-        # Check if email already exists
-        c.execute("SELECT id FROM users WHERE email = ?", (email,))
-        if c.fetchone():
-            return jsonify({'error': 'Email already exists'}), 400
-            
-        # Insert new user
-        c.execute("""
-            INSERT INTO users (firstName, lastName, email, password, phone, is_admin) 
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (firstName, lastName, email, password, phone, 0))
+        # Check if email already exists, without holding a connection
+        # while the password is hashed
+        with db.pooled_connection() as conn:
+            if conn.execute("SELECT id FROM users WHERE email = ?", (email,)).fetchone():
+                return jsonify({'error': 'Email already exists'}), 400
         
-        conn.commit()
+        password_hash = passwords.hash_password(password)
         
-        # Get the created user
-        c.execute("SELECT * FROM users WHERE email = ?", (email,))
-        user = c.fetchone()
+        with db.pooled_connection() as conn:
+            try:
+                # Insert new user
+                c = conn.cursor()
+                c.execute("""
+                    INSERT INTO users (firstName, lastName, email, password, phone, is_admin) 
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (firstName, lastName, email, password_hash, phone, 0))
+                user_id = c.lastrowid
+                conn.commit()
+            except sqlite3.IntegrityError:
+                # Registered by a concurrent request while we were hashing
+                conn.rollback()
+                return jsonify({'error': 'Email already exists'}), 400
+            except sqlite3.Error:
+                conn.rollback()
+                raise
         
         return jsonify({
-            'id': user[0],
-            'firstName': user[1],
-            'lastName': user[2],
-            'email': user[3],
-            'phone': user[5],
-            'is_admin': bool(user[6])
+            'id': user_id,
+            'firstName': firstName,
+            'lastName': lastName,
+            'email': email,
+            'phone': phone,
+            'is_admin': False,
+            'token': auth.issue_token(user_id)
         })
         
+    except passwords.HashingBusy as e:
+        return jsonify({'error': str(e)}), 503
+    except db.PoolTimeout:
+        raise
     except Exception as e:
         print(f"Error during registration: {str(e)}")
-        conn.rollback()
         return jsonify({'error': str(e)}), 400
-    finally:
-        conn.close()
 
 @app.route('/api/cars', methods=['GET', 'POST'])
+@db.read_only(snapshot_unless=('include_favorites_for',))
+@conditional_get('cars', depends_on=[('favorites', 'include_favorites_for'),
+                                      ('car-counters', counters_requested)])
 def cars():
     if request.method == 'GET':
-        # Get query parameters
-        make = request.args.get('make')
-        model = request.args.get('model')
-        year_min = request.args.get('year_min')
-        year_max = request.args.get('year_max')
-        price_min = request.args.get('price_min')
-        price_max = request.args.get('price_max')
-        mileage_min = request.args.get('mileage_min')
-        mileage_max = request.args.get('mileage_max')
-        condition = request.args.get('condition')
-        sort_by = request.args.get('sort_by', 'created_at')
-        sort_order = request.args.get('sort_order', 'DESC')
-        
-        conn = sqlite3.connect('mawater.db')
+        # Filters, sort and fields are validated and typed before any SQL is
+        # chosen; the statement itself comes from a fixed set of shapes
+        cursor = request.args.get('cursor')
+        # Annotate each car with is_favorite for this user in the same query
+        favorites_for = request.args.get('include_favorites_for', type=int) or None
+        try:
+            filters = search.parse_filters(request.args)
+            q = filters.get('q', '')
+            sort_by, sort_order = search.parse_sort(request.args, bool(q))
+            fields = projection.parse_fields(request.args.get('fields'))
+        except (search.InvalidSearch, projection.InvalidFields) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        fts_query = None
+        if q:
+            fts_query = build_fts_query(q)
+            if not fts_query:
+                return jsonify({'error': 'Search query must contain letters or digits'}), 400
+        try:
+            limit = parse_limit(request.args.get('limit'))
+            position = decode_cursor(cursor, 's', 'o', 'v', 'id') if cursor else None
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if position and (position['s'] != sort_by or position['o'] != sort_order):
+            return jsonify({'error': 'Cursor does not match sort_by/sort_order'}), 400
+        
+        # conditional_get has already read the versions for the ETag
+        cache_key = (tuple(sorted(filters.items())), sort_by, sort_order, cursor, limit, favorites_for, fields,
+                     g.resource_version)
+        body = listing_cache.get(cache_key)
+        if body is not None:
+            return app.response_class(body, mimetype='application/json')
+        
+        conn = get_db()
         c = conn.cursor()
         
         try:
-            query = "SELECT * FROM cars WHERE status = 'approved'"
-            params = []
+            # Total is only counted for the first page; later pages reuse it
+            total = None
+            if not position:
+                c.execute(*search.count_query(filters, fts_query))
+                total = c.fetchone()[0]
             
-            if make:
-                query += " AND make LIKE ?"
-                params.append(f"%{make}%")
-            if model:
-                query += " AND model LIKE ?"
-                params.append(f"%{model}%")
-            if year_min:
-                query += " AND year >= ?"
-                params.append(year_min)
-            if year_max:
-                query += " AND year <= ?"
-                params.append(year_max)
-            if price_min:
-                query += " AND price >= ?"
-                params.append(price_min)
-            if price_max:
-                query += " AND price <= ?"
-                params.append(price_max)
-            if mileage_min:
-                query += " AND mileage >= ?"
-                params.append(mileage_min)
-            if mileage_max:
-                query += " AND mileage <= ?"
-                params.append(mileage_max)
-            if condition:
-                query += " AND condition = ?"
-                params.append(condition)
+            # Only the requested fields are read; the sort value follows them.
+            # Free-text search drives the query from the FTS index.
+            columns = projection.select_list(fields, 'cars', photos_column('cars.id'))
+            c.execute(*search.page_query(filters, sort_by, sort_order, columns, limit, fts_query,
+                                         favorites_for, position))
+            rows = c.fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
             
-            query += f" ORDER BY {sort_by} {sort_order}"
+            next_cursor = None
+            if has_more:
+                last = rows[-1]
+                next_cursor = encode_cursor(s=sort_by, o=sort_order, v=last[len(fields)], id=last[0])
             
-            c.execute(query, params)
-            cars = c.fetchall()
+            cars = [project_car(fields, car) for car in rows]
+            if favorites_for:
+                for listing, car in zip(cars, rows):
+                    listing['is_favorite'] = bool(car[len(fields) + 1])
             
-            return jsonify([{
-                'id': car[0],
-                'make': car[1],
-                'model': car[2],
-                'year': car[3],
-                'price': car[4],
-                'mileage': car[5],
-                'condition': car[6],
-                'description': car[7],
-                'user_id': car[8],
-                'status': car[9],
-                'created_at': car[10]
-            } for car in cars])
+            body = projection.dumps({
+                'cars': cars,
+                'limit': limit,
+                'has_more': has_more,
+                'next_cursor': next_cursor,
+                'total': total
+            })
+            listing_cache.set(cache_key, body)
+            return app.response_class(body, mimetype='application/json')
             
         except Exception as e:
             print(f"Error fetching cars: {str(e)}")
             return jsonify({'error': str(e)}), 400
-        finally:
-            conn.close()
             
     elif request.method == 'POST':
+        user_id = auth.current_principal(allow_legacy=False).id
         try:
-            data = request.json
-            user_id = data.get('user_id')
-            
-            if not user_id:
-                return jsonify({'error': 'User ID is required'}), 400
+            # A multipart form carries the same fields plus the photo files
+            uploads = []
+            if request.mimetype == 'multipart/form-data':
+                data = request.form
+                uploads = [upload for upload in request.files.getlist('photos') if upload.filename]
+            else:
+                data = request.json
             
-            # Convert data types
             try:
-                year = int(data.get('year', 0))
-                price = float(data.get('price', 0))
-                mileage = int(data.get('mileage', 0)) if data.get('mileage') else None
-            except (ValueError, TypeError) as e:
-                return jsonify({'error': 'Invalid data types. Year and price must be numbers.'}), 400
-            
-            # Validate required fields
-            if not all([data.get('make'), data.get('model'), year > 0, price > 0]):
-                return jsonify({'error': 'Make, model, year, and price are required'}), 400
+                values = car_values(data)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
             
-            conn = sqlite3.connect('mawater.db')
+            conn = get_db()
             c = conn.cursor()
             
             try:
-                c.execute("""
-                    INSERT INTO cars (
-                        make, 
-                        model, 
-                        year, 
-                        price, 
-                        mileage, 
-                        condition, 
-                        description, 
-                        user_id,
-                        status
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    data.get('make'),
-                    data.get('model'),
-                    year,
-                    price,
-                    mileage,
-                    data.get('condition'),
-                    data.get('description'),
-                    user_id,
-                    'pending'  # Set initial status as pending
-                ))
+                c.execute(f"""
+                    INSERT INTO cars ({', '.join(CAR_INSERT_COLUMNS)})
+                    VALUES ({', '.join('?' * len(CAR_INSERT_COLUMNS))})
+                """, values + (user_id, 'pending'))  # Set initial status as pending
+                car_id = c.lastrowid
                 
+                # The car and its photos are committed together
+                names = save_photos(conn, car_id, uploads) if uploads else []
                 conn.commit()
-                car_id = c.lastrowid
                 
                 # Fetch the created car
                 c.execute("SELECT * FROM cars WHERE id = ?", (car_id,))
@@ -305,75 +610,58 @@ def cars():
                         'description': car[7],
                         'user_id': car[8],
                         'status': car[9],
-                        'created_at': car[10]
+                        'created_at': car[10],
+                        'photos': photo_urls(','.join(names), thumbnails=False)
                     }
                 })
                 
+            except photos.InvalidPhoto as e:
+                conn.rollback()
+                return jsonify({'error': str(e)}), 400
             except Exception as e:
                 print(f"Database error: {str(e)}")
                 conn.rollback()
                 return jsonify({'error': f'Error saving car: {str(e)}'}), 400
-            finally:
-                conn.close()
                 
+        except db.PoolTimeout:
+            raise
         except Exception as e:
             print(f"Error listing car: {str(e)}")
             return jsonify({'error': str(e)}), 400
 
 @app.route('/api/cars/<int:car_id>', methods=['GET', 'PUT', 'DELETE'])
+@view_counter.counts_views('car_id')
+@db.read_only
+@conditional_get('car', scope='car_id')
 def car(car_id):
-    conn = sqlite3.connect('mawater.db')
+    conn = get_db()
     c = conn.cursor()
     
     if request.method == 'GET':
         try:
-            c.execute("SELECT * FROM cars WHERE id = ?", (car_id,))
+            fields = projection.CAR_FIELDS
+            c.execute(f"SELECT {projection.select_list(fields, 'cars', photos_column('cars.id'))} "
+                      "FROM cars WHERE id = ?", (car_id,))
             car = c.fetchone()
             
             if car:
-                return jsonify({
-                    'id': car[0],
-                    'make': car[1],
-                    'model': car[2],
-                    'year': car[3],
-                    'price': car[4],
-                    'mileage': car[5],
-                    'condition': car[6],
-                    'description': car[7],
-                    'user_id': car[8],
-                    'status': car[9],
-                    'created_at': car[10]
-                })
+                car = dict(zip(fields, car))
+                names = car['photos']
+                car['photos'] = photo_urls(names, thumbnails=False)
+                car['thumbnails'] = photo_urls(names)
+                return jsonify(car)
             else:
                 return jsonify({'error': 'Car not found'}), 404
                 
         except Exception as e:
             print(f"Error fetching car: {str(e)}")
             return jsonify({'error': str(e)}), 400
-        finally:
-            conn.close()
             
     elif request.method == 'PUT':
         data = request.json
-        user_id = data.get('user_id')
-        
-        if not user_id:
-            return jsonify({'error': 'User ID is required'}), 400
+        principal = auth.current_principal(allow_legacy=False)
         
         try:
-            # Check if user owns the car or is admin
-            c.execute("SELECT user_id FROM cars WHERE id = ?", (car_id,))
-            car = c.fetchone()
-            
-            if not car:
-                return jsonify({'error': 'Car not found'}), 404
-            
-            c.execute("SELECT is_admin FROM users WHERE id = ?", (user_id,))
-            user = c.fetchone()
-            
-            if car[0] != user_id and not user[0]:
-                return jsonify({'error': 'Unauthorized'}), 403
-            
             # Update car
             update_fields = []
             params = []
@@ -383,42 +671,37 @@ def car(car_id):
                     update_fields.append(f"{field} = ?")
                     params.append(data[field])
             
-            if update_fields:
-                params.append(car_id)
-                query = f"UPDATE cars SET {', '.join(update_fields)} WHERE id = ?"
-                c.execute(query, params)
-                conn.commit()
+            if not update_fields:
+                c.execute(f"SELECT * FROM cars WHERE id = ? AND {OWNED_BY}", (car_id, principal.id, principal.is_admin))
+                if not c.fetchone():
+                    return car_write_refused(c, car_id)
+                return jsonify({'message': 'Car updated successfully'})
+            
+            # The ownership check is part of the UPDATE itself
+            params += [car_id, principal.id, principal.is_admin]
+            query = f"UPDATE cars SET {', '.join(update_fields)} WHERE id = ? AND {OWNED_BY} RETURNING *"
+            c.execute(query, params)
+            updated = c.fetchone()
+            if not updated:
+                return car_write_refused(c, car_id)
+            conn.commit()
                 
             return jsonify({'message': 'Car updated successfully'})
             
         except Exception as e:
             print(f"Error updating car: {str(e)}")
             return jsonify({'error': str(e)}), 400
-        finally:
-            conn.close()
             
     elif request.method == 'DELETE':
-        user_id = request.args.get('user_id')
-        
-        if not user_id:
-            return jsonify({'error': 'User ID is required'}), 400
+        principal = auth.current_principal(allow_legacy=False)
         
         try:
-            # Check if user owns the car or is admin
-            c.execute("SELECT user_id FROM cars WHERE id = ?", (car_id,))
+            # Delete car, if the user owns it or is admin
+            c.execute(f"DELETE FROM cars WHERE id = ? AND {OWNED_BY} RETURNING *",
+                      (car_id, principal.id, principal.is_admin))
             car = c.fetchone()
-            
             if not car:
-                return jsonify({'error': 'Car not found'}), 404
-            
-            c.execute("SELECT is_admin FROM users WHERE id = ?", (user_id,))
-            user = c.fetchone()
-            
-            if car[0] != int(user_id) and not user[0]:
-                return jsonify({'error': 'Unauthorized'}), 403
-            
-            # Delete car
-            c.execute("DELETE FROM cars WHERE id = ?", (car_id,))
+                return car_write_refused(c, car_id)
             conn.commit()
             
             return jsonify({'message': 'Car deleted successfully'})
@@ -426,44 +709,282 @@ def car(car_id):
         except Exception as e:
             print(f"Error deleting car: {str(e)}")
             return jsonify({'error': str(e)}), 400
-        finally:
-            conn.close()
+
+def stats_window():
+    # ?days=N (default 30) as the first UTC day of the window and N
+    days = request.args.get('days', '30')
+    if not days.isdigit() or not 1 <= int(days) <= MAX_STATS_DAYS:
+        raise ValueError(f'days must be between 1 and {MAX_STATS_DAYS}')
+    days = int(days)
+    since = (datetime.utcnow().date() - timedelta(days=days - 1)).isoformat()
+    return since, days
+
+def daily_stats(rows):
+    days = [{'day': day, 'views': views, 'impressions': impressions} for day, views, impressions in rows]
+    return {
+        'days': days,
+        'views': sum(day['views'] for day in days),
+        'impressions': sum(day['impressions'] for day in days)
+    }
+
+@app.route('/api/cars/<int:car_id>/stats', methods=['GET'])
+@db.read_only
+def car_stats(car_id):
+    # Daily views and impressions of one listing, for its seller or an admin.
+    # Read from the rollups only, so the last few seconds are not counted yet.
+    principal = auth.current_principal()
+    try:
+        since, days = stats_window()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    
+    try:
+        c.execute(f"SELECT id FROM cars WHERE id = ? AND {OWNED_BY}", (car_id, principal.id, principal.is_admin))
+        if not c.fetchone():
+            return car_write_refused(c, car_id)
+        c.execute("""
+            SELECT day, views, impressions FROM car_daily_stats
+            WHERE car_id = ? AND day >= ? ORDER BY day
+        """, (car_id, since))
+        return jsonify(dict(daily_stats(c.fetchall()), car_id=car_id, since=since, window_days=days))
+        
+    except Exception as e:
+        print(f"Error fetching car stats: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/cars/impressions', methods=['POST'])
+def car_impressions():
+    # {"car_ids": [...]}: the listing cards a search page showed. Counted in
+    # memory and rolled up with the views, so this never touches the database.
+    car_ids = (request.get_json(silent=True) or {}).get('car_ids')
+    if not isinstance(car_ids, list) or not car_ids:
+        return jsonify({'error': 'car_ids must be a non-empty list'}), 400
+    if len(car_ids) > MAX_IMPRESSION_IDS:
+        return jsonify({'error': f'At most {MAX_IMPRESSION_IDS} car_ids per request'}), 400
+    try:
+        car_ids = {int(car_id) for car_id in car_ids}
+    except (TypeError, ValueError):
+        return jsonify({'error': 'car_ids must be integers'}), 400
+    view_counter.record_many(car_ids, analytics.IMPRESSION)
+    return jsonify({'recorded': len(car_ids)}), 202
+
+@app.route('/api/cars/<int:car_id>/photos', methods=['POST'])
+def car_photos(car_id):
+    # multipart/form-data with one or more "photos" files
+    principal = auth.current_principal(allow_legacy=False)
+    uploads = [upload for upload in request.files.getlist('photos') if upload.filename]
+    if not uploads:
+        return jsonify({'error': 'At least one photo is required'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    
+    try:
+        # Check if user owns the car or is admin
+        c.execute(f"SELECT * FROM cars WHERE id = ? AND {OWNED_BY}", (car_id, principal.id, principal.is_admin))
+        car = c.fetchone()
+        if not car:
+            return car_write_refused(c, car_id)
+        
+        names = save_photos(conn, car_id, uploads)
+        conn.commit()
+        
+        return jsonify({
+            'message': 'Photos uploaded successfully',
+            'photos': photo_urls(','.join(names), thumbnails=False),
+            'thumbnails': photo_urls(','.join(names))
+        }), 201
+        
+    except photos.InvalidPhoto as e:
+        conn.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error uploading photos: {str(e)}")
+        conn.rollback()
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/cars/facets', methods=['GET'])
+@conditional_get('cars')
+def car_facets():
+    # Counts per make, condition, year and price/mileage bucket for the same
+    # filters /api/cars takes, summed from the car_facets table
+    try:
+        filters = search.parse_filters(request.args)
+    except search.InvalidSearch as e:
+        return jsonify({'error': str(e)}), 400
+    fts_query = None
+    if filters.get('q'):
+        fts_query = build_fts_query(filters['q'])
+        if not fts_query:
+            return jsonify({'error': 'Search query must contain letters or digits'}), 400
+    try:
+        query, params = facets.facet_query(filters, fts_query)
+    except ValueError:
+        return jsonify({'error': 'Year, price and mileage bounds must be numbers'}), 400
+    
+    c = get_db().cursor()
+    
+    try:
+        c.execute(query, params)
+        counts = facets.count_facets(c.fetchall())
+        return jsonify({
+            'facets': facets.format_facets(counts)
+        })
+        
+    except Exception as e:
+        print(f"Error fetching facets: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/cars/import', methods=['POST'])
+def import_cars():
+    # Bulk listing for dealers: an NDJSON or CSV body with one car per line
+    # or row, validated like POST /api/cars. Valid rows are inserted with
+    # executemany in batched transactions; invalid ones are reported by line.
+    user_id = auth.current_principal(allow_legacy=False).id
+    try:
+        fmt = bulk.import_format(request.mimetype, request.args.get('format'))
+    except bulk.InvalidImport as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    insert = f"""INSERT INTO cars ({', '.join(CAR_INSERT_COLUMNS)})
+                 VALUES ({', '.join('?' * len(CAR_INSERT_COLUMNS))})"""
+    batch = []
+    imported = 0
+    failed = 0
+    errors = []
+    
+    try:
+        for line, row, error in bulk.read_rows(request.stream, fmt):
+            if error is None:
+                try:
+                    batch.append(car_values(row) + (user_id, 'pending'))
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                failed += 1
+                if len(errors) < bulk.MAX_IMPORT_ERRORS:
+                    errors.append({'line': line, 'error': error})
+                continue
+            if len(batch) >= bulk.IMPORT_BATCH_SIZE:
+                c.executemany(insert, batch)
+                conn.commit()
+                imported += len(batch)
+                batch = []
+        if batch:
+            c.executemany(insert, batch)
+            conn.commit()
+            imported += len(batch)
+        
+        # Imported cars start out pending, so no cached listing changes
+        return jsonify({
+            'imported': imported,
+            'failed': failed,
+            'errors': errors,
+            'errors_truncated': failed > len(errors)
+        }), 201 if imported else 400
+        
+    except bulk.InvalidImport as e:
+        conn.rollback()
+        return jsonify({'error': str(e), 'imported': imported}), 400
+    except Exception as e:
+        print(f"Error importing cars: {str(e)}")
+        conn.rollback()
+        return jsonify({'error': str(e), 'imported': imported}), 400
+
+@app.route('/api/cars/export', methods=['GET'])
+def export_cars():
+    # Streams the user's listings (every listing for admins, optionally by
+    # status) as NDJSON or CSV, reading them in id-ordered batches
+    principal = auth.current_principal(allow_legacy=False)
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in bulk.FORMATS:
+        return jsonify({'error': f"Invalid format. Must be one of: {', '.join(bulk.FORMATS)}"}), 400
+    status = request.args.get('status')
+    
+    where = "WHERE id > ?"
+    params = []
+    if not principal.is_admin:
+        where += " AND user_id = ?"
+        params.append(principal.id)
+    if status:
+        where += " AND status = ?"
+        params.append(status)
+    query = f"SELECT {', '.join(bulk.EXPORT_FIELDS)} FROM cars {where} ORDER BY id LIMIT ?"
+    
+    def batches():
+        # Like the message stream, only hold a connection while querying
+        last_id = 0
+        while True:
+            with db.pooled_connection() as conn:
+                rows = conn.execute(query, [last_id] + params + [bulk.EXPORT_BATCH_SIZE]).fetchall()
+            if not rows:
+                return
+            yield rows
+            if len(rows) < bulk.EXPORT_BATCH_SIZE:
+                return
+            last_id = rows[-1][0]
+    
+    return app.response_class(bulk.export_chunks(batches(), fmt), mimetype=bulk.FORMATS[fmt], headers={
+        'Content-Disposition': f'attachment; filename=cars.{fmt}'
+    })
+
+def send_photo(directory, name, max_age=photos.CACHE_MAX_AGE, immutable=True):
+    response = send_from_directory(directory, photos.sharded(name), max_age=max_age, conditional=True)
+    response.cache_control.immutable = immutable
+    # Served with the type of the stored extension, never a sniffed one
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+@app.route('/photos/<name>', methods=['GET'])
+def photo(name):
+    # Content-addressed, so the bytes behind a name never change
+    if not photos.PHOTO_NAME.match(name):
+        return jsonify({'error': 'Photo not found'}), 404
+    return send_photo(photos.originals_dir(), name)
+
+@app.route('/photos/thumbnails/<name>', methods=['GET'])
+def photo_thumbnail(name):
+    if not photos.PHOTO_NAME.match(name):
+        return jsonify({'error': 'Photo not found'}), 404
+    thumbnail = photos.thumbnail_name(name)
+    if os.path.exists(os.path.join(photos.thumbnails_dir(), photos.sharded(thumbnail))):
+        return send_photo(photos.thumbnails_dir(), thumbnail)
+    # Not resized yet (or no imaging library): serve the original briefly
+    return send_photo(photos.originals_dir(), name, max_age=60, immutable=False)
 
 @app.route('/api/messages', methods=['GET', 'POST'])
+@conditional_get('messages', scope=principal_id)
 def messages():
-    user_id = request.args.get('user_id')
-    if not user_id:
-        return jsonify({'error': 'User ID is required'}), 400
+    user_id = auth.current_principal(allow_legacy=request.method == 'GET').id
     
-    conn = sqlite3.connect('mawater.db')
+    conn = get_db()
     c = conn.cursor()
     
     if request.method == 'GET':
         try:
-            # Get all conversations for the user
+            # Inbox summary rows are kept current by triggers on messages
             c.execute("""
-                SELECT DISTINCT 
-                    CASE 
-                        WHEN m.sender_id = ? THEN m.receiver_id 
-                        ELSE m.sender_id 
-                    END as other_user_id,
+                SELECT 
+                    cv.other_user_id,
                     u.firstName,
                     u.lastName,
                     c.make,
                     c.model,
                     c.year,
-                    MAX(m.created_at) as last_message_time,
-                    COUNT(CASE WHEN m.read = 0 AND m.receiver_id = ? THEN 1 END) as unread_count
-                FROM messages m
-                JOIN users u ON u.id = CASE 
-                    WHEN m.sender_id = ? THEN m.receiver_id 
-                    ELSE m.sender_id 
-                END
-                LEFT JOIN cars c ON c.id = m.car_id
-                WHERE m.sender_id = ? OR m.receiver_id = ?
-                GROUP BY other_user_id
-                ORDER BY last_message_time DESC
-            """, (user_id, user_id, user_id, user_id, user_id))
+                    cv.last_message_time,
+                    cv.unread_count,
+                    cv.last_message_preview
+                FROM conversations cv
+                JOIN users u ON u.id = cv.other_user_id
+                LEFT JOIN cars c ON c.id = cv.car_id
+                WHERE cv.user_id = ?
+                ORDER BY cv.last_message_id DESC
+            """, (user_id,))
             
             conversations = [{
                 'other_user_id': row[0],
@@ -473,7 +994,8 @@ def messages():
                 'car_model': row[4],
                 'car_year': row[5],
                 'last_message_time': row[6],
-                'unread_count': row[7]
+                'unread_count': row[7],
+                'last_message_preview': row[8]
             } for row in c.fetchall()]
             
             return jsonify(conversations)
@@ -492,151 +1014,276 @@ def messages():
             return jsonify({'error': 'Receiver ID and message are required'}), 400
         
         try:
-            c.execute("""
+            # Group-committed with other small writes; returns once durable
+            write_queue.execute("""
                 INSERT INTO messages (sender_id, receiver_id, car_id, message)
                 VALUES (?, ?, ?, ?)
-            """, (user_id, receiver_id, car_id, message))
-            
-            conn.commit()
+            """, (user_id, receiver_id, car_id, message), user_id=user_id,
+                on_commit=lambda _: notify_users(user_id, receiver_id))
             return jsonify({'message': 'Message sent successfully'})
             
+        except (writequeue.WriteQueueFull, writequeue.WriteTimeout):
+            # Answered by their error handlers with a 503/504
+            raise
         except Exception as e:
             print(f"Error sending message: {str(e)}")
             return jsonify({'error': str(e)}), 400
-        conn.close()
 
 @app.route('/api/messages/<int:conversation_id>', methods=['GET'])
+@conditional_get('messages', scope=principal_id, writes=True)
 def conversation_messages(conversation_id):
-    user_id = request.args.get('user_id')
-    if not user_id:
-        return jsonify({'error': 'User ID is required'}), 400
+    user_id = auth.current_principal().id
+    
+    # Latest page by default; before=<id> pages back through history and
+    # after=<id> fetches only messages newer than the client already has
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    if before is not None and after is not None:
+        return jsonify({'error': 'Use either before or after, not both'}), 400
+    try:
+        limit = parse_limit(request.args.get('limit'), default=MESSAGE_PAGE_SIZE, maximum=MAX_MESSAGE_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if after is not None:
+        op, direction, bound = '>', 'ASC', after
+    else:
+        op, direction, bound = '<', 'DESC', before if before is not None else MAX_MESSAGE_ID
     
-    conn = sqlite3.connect('mawater.db')
+    conn = get_db()
     c = conn.cursor()
     
     try:
-        # Mark messages as read
-        c.execute("""
-            UPDATE messages 
-            SET read = 1 
-            WHERE receiver_id = ? AND sender_id = ?
-        """, (user_id, conversation_id))
+        # Mark messages as read, skipping the write entirely when the inbox
+        # summary says there is nothing unread from this sender. The receipt
+        # is queued rather than waited for; this page already shows them read.
+        marked = False
+        if before is None:
+            c.execute("""
+                SELECT unread_count FROM conversations
+                WHERE user_id = ? AND other_user_id = ?
+            """, (user_id, conversation_id))
+            summary = c.fetchone()
+            if summary and summary[0] > 0:
+                write_queue.submit("""
+                    UPDATE messages 
+                    SET read = 1 
+                    WHERE receiver_id = ? AND sender_id = ? AND read = 0
+                """, (user_id, conversation_id), user_id=user_id,
+                    on_commit=lambda count: count and notify_users(user_id))
+                marked = True
         
-        # Get conversation messages
-        c.execute("""
+        # Each direction of the conversation is a bounded range on the
+        # (sender_id, receiver_id, id) index; the union picks the page
+        page = f"""
+            SELECT id FROM messages
+            WHERE sender_id = ? AND receiver_id = ? AND id {op} ?
+            ORDER BY id {direction} LIMIT ?
+        """
+        c.execute(f"""
             SELECT 
                 m.*,
                 s.firstName as sender_firstName,
                 s.lastName as sender_lastName,
                 r.firstName as receiver_firstName,
                 r.lastName as receiver_lastName
-            FROM messages m
+            FROM (
+                SELECT id FROM ({page})
+                UNION
+                SELECT id FROM ({page})
+                ORDER BY id {direction}
+                LIMIT ?
+            ) p
+            JOIN messages m ON m.id = p.id
             JOIN users s ON s.id = m.sender_id
             JOIN users r ON r.id = m.receiver_id
-            WHERE (m.sender_id = ? AND m.receiver_id = ?)
-               OR (m.sender_id = ? AND m.receiver_id = ?)
-            ORDER BY m.created_at ASC
-        """, (user_id, conversation_id, conversation_id, user_id))
-        
-        messages = [{
-            'id': row[0],
-            'sender_id': row[1],
-            'receiver_id': row[2],
-            'car_id': row[3],
-            'message': row[4],
-            'read': row[5],
-            'created_at': row[6],
-            'sender_name': f"{row[7]} {row[8]}",
-            'receiver_name': f"{row[9]} {row[10]}"
-        } for row in c.fetchall()]
+            ORDER BY m.id ASC
+        """, (user_id, conversation_id, bound, limit + 1,
+              conversation_id, user_id, bound, limit + 1,
+              limit + 1))
+        rows = c.fetchall()
         
-        conn.commit()
-        return jsonify(messages)
+        has_more = len(rows) > limit
+        if has_more:
+            # Drop the extra row from the far end of the page
+            rows = rows[:limit] if after is not None else rows[1:]
+        
+        if marked:
+            rows = [row[:5] + (1,) + row[6:] if row[2] == user_id else row for row in rows]
+        return jsonify({
+            'messages': [message_to_dict(row) for row in rows],
+            'has_more': has_more
+        })
         
     except Exception as e:
         print(f"Error fetching conversation: {str(e)}")
         return jsonify({'error': str(e)}), 400
-    finally:
-        conn.close()
+
+@app.route('/api/messages/stream', methods=['GET'])
+def message_stream():
+    user_id = auth.stream_principal().id
+    
+    # Resume point: EventSource sends Last-Event-ID on reconnect
+    since_id = request.headers.get('Last-Event-ID') or request.args.get('since_id')
+    try:
+        since_id = int(since_id) if since_id else None
+    except ValueError:
+        return jsonify({'error': 'since_id must be a message id'}), 400
+    
+    try:
+        subscription = message_hub.subscribe(user_id)
+    except StreamLimitReached as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '30'}
+    
+    def generate():
+        # Holds a pooled connection only while querying, never while idle.
+        # Under the gevent worker an idle stream is a parked greenlet; under
+        # gthread it keeps its request thread (see events.MAX_STREAMS).
+        # Every wake-up (publish or heartbeat timeout) re-reads from the last
+        # delivered id, which also picks up writes made by other processes.
+        last_id = since_id
+        last_unread = None
+        try:
+            yield 'retry: 3000\n\n'
+            while not message_hub.closed:
+                with db.pooled_connection() as conn:
+                    c = conn.cursor()
+                    if last_id is None:
+                        c.execute("SELECT IFNULL(MAX(id), 0) FROM messages")
+                        last_id = c.fetchone()[0]
+                    c.execute("""
+                        SELECT 
+                            m.*,
+                            s.firstName, s.lastName,
+                            r.firstName, r.lastName
+                        FROM messages m
+                        JOIN users s ON s.id = m.sender_id
+                        JOIN users r ON r.id = m.receiver_id
+                        WHERE m.id > ? AND (m.receiver_id = ? OR m.sender_id = ?)
+                        ORDER BY m.id ASC
+                        LIMIT ?
+                    """, (last_id, user_id, user_id, STREAM_BATCH_SIZE))
+                    rows = c.fetchall()
+                    c.execute("SELECT COUNT(*) FROM messages WHERE receiver_id = ? AND read = 0", (user_id,))
+                    unread = c.fetchone()[0]
+                
+                for row in rows:
+                    last_id = row[0]
+                    yield format_event(json.dumps(message_to_dict(row)), 'message', row[0])
+                if unread != last_unread:
+                    last_unread = unread
+                    yield format_event(json.dumps({'unread_count': unread}), 'unread')
+                if len(rows) == STREAM_BATCH_SIZE:
+                    continue
+                if not subscription.wait():
+                    yield ': keepalive\n\n'
+        finally:
+            subscription.close()
+    
+    response = app.response_class(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Also covers responses closed before the generator ever started
+    response.call_on_close(subscription.close)
+    return response
+
+@app.route('/api/messages/stream/token', methods=['POST'])
+def message_stream_token():
+    # For the EventSource URL, which cannot carry the Authorization header
+    principal = auth.current_principal(allow_legacy=False)
+    return jsonify({'token': auth.issue_token(principal.id, auth.STREAM_TOKEN_SALT)})
 
 @app.route('/api/my-cars', methods=['GET'])
+@db.read_only(live=True)
+@conditional_get('my-cars', scope=principal_id)
 def my_cars():
-    user_id = request.args.get('user_id')
-    if not user_id:
-        return jsonify({'error': 'User ID is required'}), 400
+    user_id = auth.current_principal().id
     
-    conn = sqlite3.connect('mawater.db')
+    conn = get_db()
     c = conn.cursor()
     
     try:
-        c.execute("""
-            SELECT c.*, COUNT(f.id) as favorite_count
+        # Favorite and view counts are maintained on the car row
+        c.execute(f"""
+            SELECT {projection.select_list(MY_CAR_FIELDS, 'c', photos_column('c.id'))}
             FROM cars c
-            LEFT JOIN favorites f ON f.car_id = c.id
             WHERE c.user_id = ?
-            GROUP BY c.id
             ORDER BY c.created_at DESC
         """, (user_id,))
         
-        cars = [{
-            'id': row[0],
-            'make': row[1],
-            'model': row[2],
-            'year': row[3],
-            'price': row[4],
-            'mileage': row[5],
-            'condition': row[6],
-            'description': row[7],
-            'status': row[9],
-            'created_at': row[10],
-            'favorite_count': row[11]
-        } for row in c.fetchall()]
+        cars = [project_car(MY_CAR_FIELDS, row) for row in c.fetchall()]
         
         return jsonify(cars)
         
     except Exception as e:
         print(f"Error fetching user's cars: {str(e)}")
         return jsonify({'error': str(e)}), 400
-    finally:
-        conn.close()
+
+@app.route('/api/my-cars/stats', methods=['GET'])
+@db.read_only
+def my_cars_stats():
+    # The seller's daily views and impressions over all their listings, plus
+    # totals per listing over the same window, from the rollups only
+    principal = auth.current_principal()
+    try:
+        since, days = stats_window()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    
+    try:
+        c.execute("""
+            SELECT day, views, impressions FROM seller_daily_stats
+            WHERE user_id = ? AND day >= ? ORDER BY day
+        """, (principal.id, since))
+        stats = daily_stats(c.fetchall())
+        c.execute("""
+            SELECT s.car_id, SUM(s.views), SUM(s.impressions)
+            FROM cars c JOIN car_daily_stats s ON s.car_id = c.id
+            WHERE c.user_id = ? AND s.day >= ?
+            GROUP BY s.car_id
+        """, (principal.id, since))
+        stats['cars'] = [{'car_id': car_id, 'views': views, 'impressions': impressions}
+                         for car_id, views, impressions in c.fetchall()]
+        return jsonify(dict(stats, user_id=principal.id, since=since, window_days=days))
+        
+    except Exception as e:
+        print(f"Error fetching seller stats: {str(e)}")
+        return jsonify({'error': str(e)}), 400
 
 @app.route('/api/favorites', methods=['GET', 'POST', 'DELETE'])
+@db.read_only(live=True)
+@conditional_get('favorites', scope=principal_id)
 def favorites():
-    user_id = request.args.get('user_id')
-    if not user_id:
-        return jsonify({'error': 'User ID is required'}), 400
+    user_id = auth.current_principal(allow_legacy=request.method == 'GET').id
     
-    conn = sqlite3.connect('mawater.db')
+    conn = get_db()
     c = conn.cursor()
     
     if request.method == 'GET':
         try:
-            c.execute("""
-                SELECT c.*, f.created_at as favorited_at
+            fields = projection.parse_fields(request.args.get('fields'), allowed=FAVORITE_FIELDS)
+            c.execute(f"""
+                SELECT {projection.select_list(fields, 'c', photos_column('c.id'))}, f.created_at as favorited_at
                 FROM cars c
                 JOIN favorites f ON c.id = f.car_id
                 WHERE f.user_id = ? AND c.status = 'approved'
                 ORDER BY f.created_at DESC
             """, (user_id,))
             
-            favorites = c.fetchall()
-            return jsonify([{
-                'id': car[0],
-                'make': car[1],
-                'model': car[2],
-                'year': car[3],
-                'price': car[4],
-                'mileage': car[5],
-                'condition': car[6],
-                'description': car[7],
-                'favorited_at': car[11]
-            } for car in favorites])
+            favorites = []
+            for car in c.fetchall():
+                favorite = project_car(fields, car)
+                favorite['favorited_at'] = car[len(fields)]
+                favorites.append(favorite)
+            return app.response_class(projection.dumps(favorites), mimetype='application/json')
             
         except Exception as e:
             print(f"Error fetching favorites: {str(e)}")
             return jsonify({'error': str(e)}), 400
-        finally:
-            conn.close()
     
     elif request.method == 'POST':
         car_id = request.json.get('car_id')
@@ -644,17 +1291,16 @@ def favorites():
             return jsonify({'error': 'Car ID is required'}), 400
         
         try:
-            c.execute("INSERT INTO favorites (user_id, car_id) VALUES (?, ?)",
-                     (user_id, car_id))
-            conn.commit()
+            write_queue.execute("INSERT INTO favorites (user_id, car_id) VALUES (?, ?)",
+                                (user_id, car_id), user_id=user_id)
             return jsonify({'message': 'Car added to favorites'})
         except sqlite3.IntegrityError:
             return jsonify({'error': 'Car already in favorites'}), 400
+        except (writequeue.WriteQueueFull, writequeue.WriteTimeout):
+            raise
         except Exception as e:
             print(f"Error adding to favorites: {str(e)}")
             return jsonify({'error': str(e)}), 400
-        finally:
-            conn.close()
     
     elif request.method == 'DELETE':
         car_id = request.args.get('car_id')
@@ -662,39 +1308,172 @@ def favorites():
             return jsonify({'error': 'Car ID is required'}), 400
         
         try:
-            c.execute("DELETE FROM favorites WHERE user_id = ? AND car_id = ?",
-                     (user_id, car_id))
-            conn.commit()
+            write_queue.execute("DELETE FROM favorites WHERE user_id = ? AND car_id = ?",
+                                (user_id, car_id), user_id=user_id)
             return jsonify({'message': 'Car removed from favorites'})
+        except (writequeue.WriteQueueFull, writequeue.WriteTimeout):
+            raise
         except Exception as e:
             print(f"Error removing from favorites: {str(e)}")
             return jsonify({'error': str(e)}), 400
-        finally:
-            conn.close()
+
+@app.route('/api/favorites/check', methods=['GET', 'POST'])
+def favorites_check():
+    # car_ids=1,2,3 (or a JSON body {"car_ids": [...]}) returns the subset the
+    # user has favorited; a single car_id keeps the {"is_favorite": ...} shape
+    user_id = auth.current_principal().id
+    
+    single = request.args.get('car_id')
+    if request.method == 'POST':
+        raw_ids = (request.json or {}).get('car_ids') or []
+    elif single:
+        raw_ids = [single]
+    else:
+        raw_ids = [part for part in request.args.get('car_ids', '').split(',') if part.strip()]
+    
+    try:
+        car_ids = sorted({int(car_id) for car_id in raw_ids})
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Car IDs must be integers'}), 400
+    if not car_ids:
+        return jsonify({'error': 'Car ID is required'}), 400
+    if len(car_ids) > MAX_FAVORITE_CHECK_IDS:
+        return jsonify({'error': f'At most {MAX_FAVORITE_CHECK_IDS} car IDs per request'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    
+    try:
+        # One probe of the (user_id, car_id) unique index per id
+        c.execute(f"""
+            SELECT car_id FROM favorites
+            WHERE user_id = ? AND car_id IN ({', '.join('?' * len(car_ids))})
+        """, [user_id] + car_ids)
+        favorite_ids = sorted(row[0] for row in c.fetchall())
+        
+        if single and request.method == 'GET':
+            return jsonify({'car_id': car_ids[0], 'is_favorite': bool(favorite_ids)})
+        return jsonify({'favorites': favorite_ids})
+        
+    except Exception as e:
+        print(f"Error checking favorites: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+
+@app.errorhandler(auth.AuthError)
+def auth_error(e):
+    return jsonify({'error': str(e)}), e.status
+
+@app.errorhandler(writequeue.WriteQueueFull)
+def write_queue_full(e):
+    print(f"Write queue full: {str(e)}")
+    return jsonify({'error': 'Server busy, please retry'}), 503
+
+@app.errorhandler(writequeue.WriteTimeout)
+def write_timeout(e):
+    print(f"Write timed out: {str(e)}")
+    return jsonify({'error': 'The write was not confirmed in time and may still apply; '
+                             'reload before retrying'}), 504
+
+@app.errorhandler(db.PoolTimeout)
+def pool_timeout(e):
+    print(f"Database pool exhausted: {str(e)}")
+    return jsonify({'error': 'Server busy, please retry'}), 503
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # Liveness: the process is up and serving; nothing else is checked
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # Readiness: the database answers and the schema is current
+    if app.config.get('SHUTTING_DOWN'):
+        return jsonify({'status': 'shutting down'}), 503
+    try:
+        version = migrations.schema_version(get_db())
+    except Exception as e:
+        print(f"Error checking readiness: {str(e)}")
+        return jsonify({'status': 'database unavailable', 'error': str(e)}), 503
+    if version < migrations.MIGRATIONS[-1][0]:
+        return jsonify({'status': 'migrations pending', 'schema_version': version}), 503
+    return jsonify({'status': 'ready', 'schema_version': version})
+
+@app.route('/api/db/stats', methods=['GET'])
+def db_stats():
+    return jsonify({
+        'pool': db.pool.stats(),
+        'read_pool': db.read_pool.stats(),
+        'snapshot': db.snapshot.stats() if db.snapshot is not None else None,
+        'write_queue': write_queue.stats(),
+        'statement_cache': dict(metrics.registry.statement_cache_stats(), size=db.STATEMENT_CACHE_SIZE),
+        'search_statements': search.stats()
+    })
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'listings': listing_cache.stats(), 'principals': auth.principals.stats()})
+
+@app.route('/api/http/stats', methods=['GET'])
+def http_stats():
+    return jsonify({'endpoints': httpcache.stats()})
+
+@app.route('/api/analytics/stats', methods=['GET'])
+def analytics_stats():
+    return jsonify({'views': view_counter.stats()})
+
+@app.route('/api/photos/stats', methods=['GET'])
+def photo_stats():
+    return jsonify({'thumbnails': thumbnail_worker.stats()})
+
+@app.route('/api/auth/stats', methods=['GET'])
+def auth_stats():
+    return jsonify({'hashing': passwords.pool.stats()})
+
+@app.route('/api/db/slow-queries', methods=['GET'])
+def slow_queries():
+    auth.require_admin()
+    return jsonify({'threshold_ms': metrics.SLOW_QUERY_MS, 'queries': metrics.registry.slow_query_log()})
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    gauges = {
+        'db_pool': db.pool.stats(),
+        'db_read_pool': db.read_pool.stats(),
+        'write_queue': write_queue.stats(),
+        'listing_cache': listing_cache.stats(),
+        'principal_cache': auth.principals.stats(),
+        'password_hashing': passwords.pool.stats(),
+        'thumbnails': thumbnail_worker.stats(),
+        'message_streams': message_hub.stats(),
+        'view_counter': view_counter.stats(),
+        'search_page_statements': search.stats()['page'],
+        'search_count_statements': search.stats()['count'],
+    }
+    if db.snapshot is not None:
+        gauges['db_snapshot'] = db.snapshot.stats()
+    return app.response_class(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/messages/stream/stats', methods=['GET'])
+def message_stream_stats():
+    return jsonify(message_hub.stats())
 
 # Admin routes
 @app.route('/api/admin/cars', methods=['GET'])
+@db.read_only
 def admin_cars():
-    user_id = request.args.get('user_id')
+    auth.require_admin()
     status = request.args.get('status')  # Optional status filter
     
-    if not user_id:
-        return jsonify({'error': 'User ID is required'}), 400
-    
-    conn = sqlite3.connect('mawater.db')
+    conn = get_db()
     c = conn.cursor()
     
     try:
-        # First check if user is admin
-        c.execute("SELECT is_admin FROM users WHERE id = ?", (user_id,))
-        user = c.fetchone()
-        
-        if not user or not user[0]:
-            return jsonify({'error': 'Unauthorized. Admin access required'}), 403
-        
+        # Moderators see every column but photos unless fields= narrows it
+        fields = projection.parse_fields(request.args.get('fields'), default=ADMIN_CAR_FIELDS)
         # Get all cars with user information
-        query = """
-            SELECT c.*, u.firstName, u.lastName, u.email, u.phone
+        query = f"""
+            SELECT {projection.select_list(fields, 'c', photos_column('c.id'))},
+                   u.firstName, u.lastName, u.email, u.phone
             FROM cars c
             JOIN users u ON c.user_id = u.id
         """
@@ -708,48 +1487,29 @@ def admin_cars():
         query += " ORDER BY c.created_at DESC"
         
         c.execute(query, params)
-        cars = c.fetchall()
-        
-        return jsonify([{
-            'id': car[0],
-            'make': car[1],
-            'model': car[2],
-            'year': car[3],
-            'price': car[4],
-            'mileage': car[5],
-            'condition': car[6],
-            'description': car[7],
-            'user_id': car[8],
-            'status': car[9],
-            'created_at': car[10],
-            'seller_name': f"{car[11]} {car[12]}",
-            'seller_email': car[13],
-            'seller_phone': car[14]
-        } for car in cars])
+        cars = []
+        for row in c.fetchall():
+            car = project_car(fields, row)
+            first_name, last_name, email, phone = row[len(fields):]
+            car['seller_name'] = f"{first_name} {last_name}"
+            car['seller_email'] = email
+            car['seller_phone'] = phone
+            cars.append(car)
+        
+        return app.response_class(projection.dumps(cars), mimetype='application/json')
         
     except Exception as e:
         print(f"Error fetching admin cars: {str(e)}")
         return jsonify({'error': str(e)}), 400
-    finally:
-        conn.close()
 
 @app.route('/api/admin/cars/<int:car_id>', methods=['PUT'])
 def admin_update_car(car_id):
-    user_id = request.args.get('user_id')
-    if not user_id:
-        return jsonify({'error': 'User ID is required'}), 400
+    auth.require_admin()
     
-    conn = sqlite3.connect('mawater.db')
+    conn = get_db()
     c = conn.cursor()
     
     try:
-        # Check if user is admin
-        c.execute("SELECT is_admin FROM users WHERE id = ?", (user_id,))
-        user = c.fetchone()
-        
-        if not user or not user[0]:
-            return jsonify({'error': 'Unauthorized. Admin access required'}), 403
-        
         data = request.json
         status = data.get('status')
         
@@ -775,8 +1535,150 @@ def admin_update_car(car_id):
         print(f"Error updating car status: {str(e)}")
         conn.rollback()
         return jsonify({'error': str(e)}), 400
-    finally:
-        conn.close()
+
+@app.route('/api/admin/queue', methods=['GET'])
+def admin_queue():
+    # One page of the moderation queue (oldest first by default) with the
+    # number of listings in each status, read from car_status_counts
+    auth.require_admin()
+    status = request.args.get('status', 'pending')
+    sort_order = request.args.get('sort_order', 'ASC').upper()
+    cursor = request.args.get('cursor')
+    
+    if status not in MODERATION_STATUSES:
+        return jsonify({'error': f"Invalid status. Must be one of: {', '.join(MODERATION_STATUSES)}"}), 400
+    if sort_order not in ('ASC', 'DESC'):
+        return jsonify({'error': 'Invalid sort_order. Must be ASC or DESC'}), 400
+    try:
+        limit = parse_limit(request.args.get('limit'))
+        position = decode_cursor(cursor, 's', 'o', 'v', 'id') if cursor else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if position and (position['s'] != status or position['o'] != sort_order):
+        return jsonify({'error': 'Cursor does not match status/sort_order'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    
+    try:
+        # Keyset pagination over the (status, created_at) index
+        query = """
+            SELECT c.id, c.make, c.model, c.year, c.price, c.mileage, c.condition, c.description,
+                   c.user_id, c.status, c.created_at, u.firstName, u.lastName, u.email, u.phone
+            FROM cars c
+            LEFT JOIN users u ON c.user_id = u.id
+            WHERE c.status = ?
+        """
+        params = [status]
+        if position:
+            op, tie = ('<', '<=') if sort_order == 'DESC' else ('>', '>=')
+            query += f" AND c.created_at {tie} ? AND (c.created_at {op} ? OR c.id {op} ?)"
+            params += [position['v'], position['v'], position['id']]
+        query += f" ORDER BY c.created_at {sort_order}, c.id {sort_order} LIMIT ?"
+        params.append(limit + 1)
+        
+        c.execute(query, params)
+        rows = c.fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        
+        next_cursor = None
+        if has_more:
+            next_cursor = encode_cursor(s=status, o=sort_order, v=rows[-1][10], id=rows[-1][0])
+        
+        c.execute("SELECT status, count FROM car_status_counts")
+        counts = dict.fromkeys(MODERATION_STATUSES, 0)
+        counts.update(c.fetchall())
+        
+        return jsonify({
+            'cars': [{
+                'id': car[0],
+                'make': car[1],
+                'model': car[2],
+                'year': car[3],
+                'price': car[4],
+                'mileage': car[5],
+                'condition': car[6],
+                'description': car[7],
+                'user_id': car[8],
+                'status': car[9],
+                'created_at': car[10],
+                'seller_name': f"{car[11]} {car[12]}" if car[11] else None,
+                'seller_email': car[13],
+                'seller_phone': car[14]
+            } for car in rows],
+            'counts': counts,
+            'limit': limit,
+            'has_more': has_more,
+            'next_cursor': next_cursor
+        })
+        
+    except Exception as e:
+        print(f"Error fetching moderation queue: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/admin/cars/moderate', methods=['POST'])
+def admin_moderate_cars():
+    # Applies many decisions in one transaction: either
+    # {"status": "approved", "car_ids": [...]} or
+    # {"decisions": [{"car_id": 1, "status": "rejected"}, ...]}
+    auth.require_admin()
+    
+    data = request.json or {}
+    if 'decisions' in data:
+        decisions = data.get('decisions') or []
+        pairs = [(d.get('car_id'), d.get('status')) for d in decisions if isinstance(d, dict)]
+        if len(pairs) != len(decisions):
+            return jsonify({'error': 'Each decision must be an object with car_id and status'}), 400
+    else:
+        pairs = [(car_id, data.get('status')) for car_id in data.get('car_ids') or []]
+    
+    # A car decided more than once keeps its last decision, as if they were
+    # applied in order
+    statuses = {}
+    try:
+        for car_id, status in pairs:
+            if status not in ['approved', 'rejected']:
+                return jsonify({'error': 'Invalid status. Must be approved or rejected'}), 400
+            statuses[int(car_id)] = status
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Car IDs must be integers'}), 400
+    if not pairs:
+        return jsonify({'error': 'Car ID is required'}), 400
+    if len(pairs) > MAX_MODERATION_BATCH:
+        return jsonify({'error': f'At most {MAX_MODERATION_BATCH} cars per request'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    
+    by_status = {}
+    for car_id, status in statuses.items():
+        by_status.setdefault(status, []).append(car_id)
+    
+    try:
+        changed = set()
+        for status, car_ids in by_status.items():
+            ids = sorted(car_ids)
+            c.execute(f"""
+                UPDATE cars
+                SET status = ?
+                WHERE id IN ({', '.join('?' * len(ids))}) AND status IS NOT ?
+                RETURNING id
+            """, [status] + ids + [status])
+            changed.update(row[0] for row in c.fetchall())
+        conn.commit()
+        
+        return jsonify({
+            'message': f'{len(changed)} cars updated',
+            'updated': sorted(changed),
+            'unchanged': sorted(statuses.keys() - changed)
+        })
+        
+    except Exception as e:
+        print(f"Error moderating cars: {str(e)}")
+        conn.rollback()
+        return jsonify({'error': str(e)}), 400
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Development server; production runs wsgi:app under gunicorn.conf.py
+    create_app().run(debug=os.environ.get('MAWATER_DEBUG') == '1', threaded=True)
@@ -0,0 +1,193 @@
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app, g, request
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+
+from db import get_db
+
+TOKEN_MAX_AGE = int(os.environ.get('MAWATER_TOKEN_MAX_AGE', str(30 * 24 * 3600)))
+PRINCIPAL_CACHE_SIZE = int(os.environ.get('MAWATER_PRINCIPAL_CACHE_SIZE', '10000'))
+PRINCIPAL_CACHE_TTL = float(os.environ.get('MAWATER_PRINCIPAL_CACHE_TTL', '300'))
+TOKEN_SALT = 'mawater-auth'
+STREAM_TOKEN_SALT = 'mawater-stream'
+
+Principal = namedtuple('Principal', ['id', 'is_admin'])
+
+
+class AuthError(Exception):
+    def __init__(self, message, status=401):
+        super().__init__(message)
+        self.status = status
+
+
+class PrincipalCache:
+    # Bounded LRU of user id -> Principal with a TTL, so a request resolves
+    # its user without a query. Code that changes a user's role or removes a
+    # user calls invalidate(); the TTL bounds staleness across processes.
+
+    def __init__(self, max_size=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()   # user id -> (principal, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] <= time.monotonic():
+                self._entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, principal):
+        with self._lock:
+            self._entries[principal.id] = (principal, time.monotonic() + self.ttl)
+            self._entries.move_to_end(principal.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'invalidations': self.invalidations,
+            }
+
+
+principals = PrincipalCache()
+
+
+def _serializer(salt=TOKEN_SALT):
+    return URLSafeTimedSerializer(current_app.secret_key, salt=salt)
+
+
+def issue_token(user_id, salt=TOKEN_SALT):
+    return _serializer(salt).dumps({'uid': user_id})
+
+
+def _token_user_id(token, salt=TOKEN_SALT):
+    try:
+        data = _serializer(salt).loads(token, max_age=TOKEN_MAX_AGE)
+    except SignatureExpired:
+        raise AuthError('Session expired, please log in again')
+    except BadSignature:
+        raise AuthError('Invalid token')
+    return data.get('uid')
+
+
+def _legacy_user_id():
+    # Clients from before tokens name themselves with a user_id parameter
+    # (query string, form or JSON body)
+    user_id = request.args.get('user_id') or request.form.get('user_id')
+    if user_id is None:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            user_id = body.get('user_id')
+    return user_id
+
+
+def load_principal(user_id):
+    principal = principals.get(user_id)
+    if principal is None:
+        row = get_db().execute("SELECT id, is_admin FROM users WHERE id = ?", (user_id,)).fetchone()
+        if not row:
+            return None
+        principal = Principal(row[0], bool(row[1]))
+        principals.set(principal)
+    return principal
+
+
+def _claimed_user_id(allow_legacy):
+    # The user id the request names, from a Bearer token or (when allowed)
+    # the legacy parameter, and whether it came from the latter
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        return _token_user_id(header[len('Bearer '):].strip()), False
+    if allow_legacy and current_app.config.get('AUTH_ALLOW_USER_ID_PARAM'):
+        return _legacy_user_id(), True
+    return None, False
+
+
+def _resolve(user_id, legacy):
+    if not user_id:
+        raise AuthError('Authentication required')
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        raise AuthError('Invalid user')
+    principal = load_principal(user_id)
+    if principal is None:
+        raise AuthError('Invalid user')
+    g.principal = principal
+    g.principal_is_legacy = legacy
+    return principal
+
+
+def current_principal(allow_legacy=True):
+    # The authenticated user for this request, resolved once and kept in g.
+    # A Bearer token wins over the legacy user_id parameter, which writes and
+    # admin checks never accept (allow_legacy=False): anyone can type one.
+    if 'principal' in g and (allow_legacy or not g.principal_is_legacy):
+        return g.principal
+    return _resolve(*_claimed_user_id(allow_legacy))
+
+
+def claimed_user_id():
+    # Who the request says it is, without loading the user or failing: for
+    # hints such as waiting on the user's queued writes, never for access
+    try:
+        user_id, _ = _claimed_user_id(allow_legacy=True)
+        return int(user_id) if user_id else None
+    except (AuthError, TypeError, ValueError):
+        return None
+
+
+def stream_principal():
+    # EventSource cannot send an Authorization header, so message streams
+    # take a token in the URL instead. It is signed for streams only, so one
+    # that leaks through a logged URL opens no other part of the API.
+    token = request.args.get('token')
+    if token:
+        return _resolve(_token_user_id(token, STREAM_TOKEN_SALT), False)
+    return current_principal()
+
+
+def require_admin():
+    principal = current_principal(allow_legacy=False)
+    if not principal.is_admin:
+        raise AuthError('Unauthorized. Admin access required', 403)
+    return principal
+
+
+def init_app(app):
+    if not app.secret_key:
+        app.secret_key = os.environ.get('MAWATER_SECRET_KEY')
+    if not app.secret_key:
+        # Tokens then only survive as long as this process
+        print("MAWATER_SECRET_KEY is not set; using a random per-process secret")
+        app.secret_key = secrets.token_hex(32)
+    # Off unless a deployment still has clients that only send user_id; even
+    # then it is accepted for the signed-in user's own reads only
+    app.config.setdefault('AUTH_ALLOW_USER_ID_PARAM',
+                          os.environ.get('MAWATER_AUTH_ALLOW_USER_ID', '0') == '1')
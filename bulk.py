@@ -0,0 +1,89 @@
+import codecs
+import csv
+import io
+import json
+
+IMPORT_BATCH_SIZE = 1000
+MAX_IMPORT_ERRORS = 100
+EXPORT_BATCH_SIZE = 500
+
+# Export columns, in cars table order. The import reads the listing fields
+# by name and ignores the rest, so an export can be imported again.
+EXPORT_FIELDS = ('id', 'make', 'model', 'year', 'price', 'mileage', 'condition', 'description',
+                 'user_id', 'status', 'created_at')
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+_MIMETYPE_FORMATS = {
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'application/json': 'ndjson',
+    'text/csv': 'csv',
+}
+
+
+class InvalidImport(ValueError):
+    pass
+
+
+def import_format(mimetype, requested=None):
+    fmt = requested or _MIMETYPE_FORMATS.get(mimetype)
+    if fmt not in FORMATS:
+        raise InvalidImport('Send NDJSON (application/x-ndjson) or CSV (text/csv), '
+                            'or pass format=ndjson|csv')
+    return fmt
+
+
+def _read_ndjson(lines):
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_no, None, 'Invalid JSON'
+            continue
+        if not isinstance(row, dict):
+            yield line_no, None, 'Each line must be a JSON object'
+            continue
+        yield line_no, row, None
+
+
+def _read_csv(lines):
+    # Decoded incrementally so quoted fields may span lines
+    reader = csv.DictReader(codecs.iterdecode(lines, 'utf-8-sig'))
+    for row in reader:
+        yield reader.line_num, row, None
+
+
+def read_rows(stream, fmt):
+    # Yields (line number, row dict or None, error or None) while reading the
+    # request body line by line, so the upload is never held in memory
+    rows = _read_csv(stream) if fmt == 'csv' else _read_ndjson(stream)
+    try:
+        yield from rows
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise InvalidImport(f'Unreadable {fmt.upper()} input: {str(e)}')
+
+
+def _write_ndjson(rows):
+    return ''.join(json.dumps(dict(zip(EXPORT_FIELDS, row)), separators=(',', ':')) + '\n'
+                   for row in rows)
+
+
+def _write_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def export_chunks(batches, fmt):
+    # One chunk per batch of rows; CSV starts with its header line
+    if fmt == 'csv':
+        yield _write_csv([EXPORT_FIELDS])
+    write = _write_csv if fmt == 'csv' else _write_ndjson
+    for rows in batches:
+        yield write(rows)
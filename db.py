@@ -0,0 +1,312 @@
+import functools
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+import metrics
+
+DATABASE = os.environ.get('MAWATER_DB', 'mawater.db')
+POOL_SIZE = int(os.environ.get('MAWATER_DB_POOL_SIZE', '8'))
+POOL_TIMEOUT = float(os.environ.get('MAWATER_DB_POOL_TIMEOUT', '10'))
+BUSY_TIMEOUT_MS = int(os.environ.get('MAWATER_DB_BUSY_TIMEOUT_MS', '5000'))
+# Prepared statements kept per connection, keyed by SQL text (the driver's
+# default is 128). Listing searches alone have a few hundred shapes in use.
+STATEMENT_CACHE_SIZE = int(os.environ.get('MAWATER_DB_STATEMENT_CACHE', '1024'))
+READ_POOL_SIZE = int(os.environ.get('MAWATER_DB_READ_POOL_SIZE', str(POOL_SIZE)))
+# Seconds between snapshot refreshes; 0 serves read-only views from the live
+# file instead of a snapshot
+SNAPSHOT_MAX_AGE = float(os.environ.get('MAWATER_SNAPSHOT_MAX_AGE', '0'))
+SNAPSHOT_PATH = os.environ.get('MAWATER_SNAPSHOT_PATH', f'{DATABASE}.snapshot')
+
+# Applied to every connection when it is opened. WAL lets readers run while a
+# writer holds the lock, and synchronous=NORMAL is durable under WAL while
+# skipping the fsync on every commit.
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',     # 16 MB page cache per connection
+    'PRAGMA mmap_size = 268435456',   # 256 MB memory-mapped reads
+    'PRAGMA temp_store = MEMORY',
+    f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}',
+)
+
+
+def connect(path=None, read_only=False):
+    path = path or DATABASE
+    if read_only:
+        # mode=ro refuses writes at the file level, query_only per connection
+        path = f'file:{os.path.abspath(path)}?mode=ro'
+    conn = sqlite3.connect(path,
+                           timeout=BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE_SIZE,
+                           uri=read_only,
+                           factory=metrics.connection_factory())
+    for pragma in PRAGMAS:
+        if read_only and 'journal_mode' in pragma:
+            continue
+        conn.execute(pragma)
+    if read_only:
+        conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    # A bounded set of long-lived connections. Connections are opened lazily
+    # up to max_size and handed to one request at a time, so sharing them
+    # across threads is safe even though sqlite3 objects are not thread-safe.
+
+    def __init__(self, path, max_size=POOL_SIZE, timeout=POOL_TIMEOUT, read_only=False):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.read_only = read_only
+        # Bumped by reopen(); connections from an older generation are
+        # closed instead of reused
+        self.generation = 0
+        self._generations = {}
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._size = 0
+        self._in_use = 0
+        self._acquired = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open_or_wait()
+        while self._generations.get(id(conn)) != self.generation:
+            self._discard(conn)
+            conn = self._open_or_wait()
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+        return conn
+
+    def _open_or_wait(self):
+        with self._lock:
+            can_open = self._size < self.max_size
+            if can_open:
+                self._size += 1
+        if can_open:
+            try:
+                generation = self.generation
+                conn = connect(self.path, read_only=self.read_only)
+                self._generations[id(conn)] = generation
+                return conn
+            except Exception:
+                with self._lock:
+                    self._size -= 1
+                raise
+
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeout(f'No database connection available after {self.timeout}s')
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._waits += 1
+            self._wait_time += waited
+            self._max_wait = max(self._max_wait, waited)
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        try:
+            # Never hand an open transaction to the next request
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    def _discard(self, conn):
+        self._generations.pop(id(conn), None)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._size -= 1
+
+    def reopen(self, path=None):
+        # New connections (e.g. to a refreshed snapshot) from now on; ones in
+        # use finish their request on the file they already have open
+        with self._lock:
+            if path:
+                self.path = path
+            self.generation += 1
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_size': self.max_size,
+                'generation': self.generation,
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': self._size - self._in_use,
+                'acquired': self._acquired,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'total_wait_ms': round(self._wait_time * 1000, 3),
+                'avg_wait_ms': round(self._wait_time * 1000 / self._waits, 3) if self._waits else 0.0,
+                'max_wait_ms': round(self._max_wait * 1000, 3),
+            }
+
+
+class Snapshot:
+    # A copy of the database made with the online backup API and refreshed
+    # every max_age seconds by a background thread. Read-only views served
+    # from it never share a file (or its locks and WAL) with the writers, at
+    # the cost of seeing data up to max_age seconds old.
+
+    def __init__(self, source, path, max_age):
+        self.source = source
+        self.path = path
+        self.max_age = max_age
+        self.pool = ConnectionPool(path, READ_POOL_SIZE, read_only=True)
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.refreshed_at = None
+        self.refreshes = 0
+        self.failures = 0
+        self._refresh_time = 0.0
+
+    def refresh(self):
+        start = time.perf_counter()
+        # Per-process temp file: each server process keeps its own copy fresh
+        # and the rename swaps it in atomically
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        source = connect(self.source, read_only=True)
+        target = sqlite3.connect(tmp)
+        try:
+            source.backup(target)
+            # A plain rollback-journal file, so read-only opens need no -shm
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            target.close()
+            source.close()
+        os.replace(tmp, self.path)
+        self.pool.reopen()
+        with self._lock:
+            self.refreshed_at = time.time()
+            self.refreshes += 1
+            self._refresh_time += time.perf_counter() - start
+
+    def ensure_started(self):
+        # The first copy is made by the first request that needs it; the
+        # thread starts then too, so forked workers each run their own
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self.refresh()
+                self._thread = threading.Thread(target=self._run, name='snapshot', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.max_age):
+            try:
+                self.refresh()
+            except Exception as e:
+                with self._lock:
+                    self.failures += 1
+                print(f"Error refreshing database snapshot: {str(e)}")
+
+    def close(self):
+        self._stop.set()
+        self.pool.close_all()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_age_seconds': self.max_age,
+                'age_seconds': round(time.time() - self.refreshed_at, 3) if self.refreshed_at else None,
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'avg_refresh_ms': round(self._refresh_time * 1000 / self.refreshes, 3) if self.refreshes else 0.0,
+                'pool': self.pool.stats(),
+            }
+
+
+pool = ConnectionPool(DATABASE)
+# Read-only connections to the live file for views marked read_only
+read_pool = ConnectionPool(DATABASE, READ_POOL_SIZE, read_only=True)
+snapshot = Snapshot(DATABASE, SNAPSHOT_PATH, SNAPSHOT_MAX_AGE) if SNAPSHOT_MAX_AGE > 0 else None
+
+
+def read_only(view=None, snapshot_unless=(), live=False):
+    # Routes a view's GETs to a read-only connection: the snapshot when one
+    # is configured, else the live file. Requests carrying any of the
+    # snapshot_unless arguments, and every request to a live view (e.g. one
+    # showing the user their own writes), read the live file. Writes inside
+    # such a view fail with an error.
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method == 'GET' and 'db' not in g:
+                use_snapshot = snapshot is not None and not live and not any(
+                    name in request.args or name in kwargs for name in snapshot_unless)
+                if use_snapshot:
+                    snapshot.ensure_started()
+                g.db_pool = snapshot.pool if use_snapshot else read_pool
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator(view) if view is not None else decorator
+
+
+def get_db():
+    # One pooled connection per request, returned on app context teardown
+    if 'db' not in g:
+        g.db = g.setdefault('db_pool', pool).acquire()
+    return g.db
+
+
+def release_db(exc=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        g.pop('db_pool', pool).release(conn)
+
+
+@contextmanager
+def pooled_connection():
+    # For work outside the request lifecycle (e.g. long-lived streams) that
+    # should only hold a connection while it is actually querying
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+def init_app(app):
+    app.teardown_appcontext(release_db)
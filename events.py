@@ -0,0 +1,112 @@
+import os
+import threading
+from collections import defaultdict
+
+try:
+    from gevent import monkey
+except ImportError:  # optional; without it every open stream holds a thread
+    monkey = None
+
+HEARTBEAT_SECONDS = float(os.environ.get('MAWATER_SSE_HEARTBEAT', '15'))
+# Under gunicorn's gevent worker (gunicorn.conf.py patches threading before
+# the app is imported) a stream waits on a cooperative event and holds no
+# thread, so the cap is about sockets. Otherwise the generator blocks its
+# request thread between wake-ups, so streams are capped at a quarter of the
+# worker's MAWATER_THREADS, leaving the rest for ordinary requests. Past the
+# cap the stream is refused with a 503 and the page falls back to polling.
+COOPERATIVE = monkey is not None and monkey.is_module_patched('threading')
+WORKER_THREADS = int(os.environ.get('MAWATER_THREADS', os.environ.get('MAWATER_DB_POOL_SIZE', '8')))
+MAX_STREAMS = int(os.environ.get('MAWATER_SSE_MAX_STREAMS',
+                                 '1000' if COOPERATIVE else str(max(1, WORKER_THREADS // 4))))
+
+
+class StreamLimitReached(Exception):
+    pass
+
+
+class Subscription:
+    def __init__(self, hub, user_id):
+        self.hub = hub
+        self.user_id = user_id
+        self._event = threading.Event()
+
+    def notify(self):
+        self._event.set()
+
+    def wait(self, timeout=HEARTBEAT_SECONDS):
+        # True when something was published for this user since the last wait
+        woke = self._event.wait(timeout)
+        self._event.clear()
+        return woke
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class MessageHub:
+    # In-process pub/sub keyed by user id. Publishing only wakes the user's
+    # open streams; the streams read what changed from the database, so a
+    # missed or coalesced notification never loses a message.
+
+    def __init__(self, max_streams=MAX_STREAMS):
+        self.max_streams = max_streams
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._count = 0
+        self.published = 0
+        # Set on shutdown; open streams end at their next wake-up
+        self.closed = False
+
+    def subscribe(self, user_id):
+        with self._lock:
+            if self.closed:
+                raise StreamLimitReached('Server is shutting down')
+            if self._count >= self.max_streams:
+                raise StreamLimitReached(f'Too many open streams ({self.max_streams})')
+            subscription = Subscription(self, user_id)
+            self._subscribers[user_id].add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers and subscription in subscribers:
+                subscribers.discard(subscription)
+                self._count -= 1
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def publish(self, *user_ids):
+        with self._lock:
+            self.published += 1
+            targets = [s for user_id in user_ids for s in self._subscribers.get(user_id, ())]
+        for subscription in targets:
+            subscription.notify()
+
+    def close(self):
+        # Wakes every open stream so it can see closed and finish
+        with self._lock:
+            self.closed = True
+            targets = [s for subscribers in self._subscribers.values() for s in subscribers]
+        for subscription in targets:
+            subscription.notify()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'open_streams': self._count,
+                'subscribed_users': len(self._subscribers),
+                'max_streams': self.max_streams,
+                'published': self.published,
+            }
+
+
+def format_event(data, event=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if event:
+        lines.append(f'event: {event}')
+    lines.extend(f'data: {line}' for line in data.splitlines() or [''])
+    return '\n'.join(lines) + '\n\n'
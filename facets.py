@@ -0,0 +1,104 @@
+from migrations import MILEAGE_BUCKETS, NO_MILEAGE, PRICE_BUCKETS, bucket_sql
+
+# Each facet is counted with every filter applied except its own, so the
+# sidebar shows what choosing another value would return
+FACETS = ('make', 'condition', 'year', 'price', 'mileage')
+
+_CUBE = """SELECT make, model, condition, year, price_bucket, mileage_bucket, count
+           FROM car_facets"""
+
+# With free-text search the counts come from the matching cars instead, found
+# through the FTS index and read by primary key (in that order, see search.py)
+_SEARCH = f"""SELECT make, model, IFNULL(condition, '') AS condition, year,
+                     {bucket_sql('price', PRICE_BUCKETS)} AS price_bucket,
+                     {bucket_sql('mileage', MILEAGE_BUCKETS, NO_MILEAGE)} AS mileage_bucket,
+                     1 AS count
+              FROM (SELECT rowid AS fts_id FROM cars_fts WHERE cars_fts MATCH ?) m
+                CROSS JOIN cars ON cars.id = m.fts_id
+              WHERE status = 'approved'"""
+
+
+def _buckets(bounds, low, high):
+    # Lower bounds of the buckets overlapping [low, high]. Ranges are applied
+    # at bucket granularity, so counts near a bound include the whole bucket.
+    uppers = list(bounds[1:]) + [float('inf')]
+    return [bound for bound, upper in zip(bounds, uppers)
+            if (low is None or upper > low) and (high is None or bound <= high)]
+
+
+def _range(low, high):
+    low = float(low) if low is not None else None
+    high = float(high) if high is not None else None
+    return low, high
+
+
+def facet_query(filters, fts_query=None):
+    # Returns (sql, params) selecting every source row that fails at most one
+    # facet's filter, with a 0/1 column per facet saying whether it passes
+    conditions = {}
+    if 'make' in filters:
+        conditions['make'] = ('make LIKE ?', [f"%{filters['make']}%"])
+    if 'condition' in filters:
+        conditions['condition'] = ('condition = ?', [filters['condition']])
+    low, high = _range(filters.get('year_min'), filters.get('year_max'))
+    bounds = [(f'year {op} ?', value) for op, value in (('>=', low), ('<=', high)) if value is not None]
+    if bounds:
+        conditions['year'] = (' AND '.join(sql for sql, _ in bounds), [value for _, value in bounds])
+    for facet, bounds in (('price', PRICE_BUCKETS), ('mileage', MILEAGE_BUCKETS)):
+        low, high = _range(filters.get(f'{facet}_min'), filters.get(f'{facet}_max'))
+        if low is not None or high is not None:
+            buckets = _buckets(bounds, low, high)
+            if buckets:
+                conditions[facet] = (f"{facet}_bucket IN ({', '.join('?' * len(buckets))})", buckets)
+            else:
+                conditions[facet] = ('0', [])
+
+    flags = []
+    flag_params = []
+    for facet in FACETS:
+        sql, values = conditions.get(facet, ('1', []))
+        flags.append(f'({sql})')
+        flag_params += values
+    where = f"{' + '.join(flags)} >= {len(FACETS) - 1}"
+    where_params = list(flag_params)
+    if 'model' in filters:
+        # Not a facet, so it narrows every count
+        where += ' AND model LIKE ?'
+        where_params.append(f"%{filters['model']}%")
+    sql = (f"SELECT make, condition, year, price_bucket, mileage_bucket, count, {', '.join(flags)} "
+           f"FROM ({_SEARCH if fts_query else _CUBE}) WHERE {where}")
+    # Parameters in the order they appear: select list, source, WHERE
+    return sql, flag_params + ([fts_query] if fts_query else []) + where_params
+
+
+def count_facets(rows):
+    # One pass over the rows from facet_query(). There is no overall total:
+    # price and mileage ranges apply at bucket granularity here, so it would
+    # disagree with /api/cars, which compares the exact values.
+    counts = {facet: {} for facet in FACETS}
+    for make, condition, year, price_bucket, mileage_bucket, count, *passes in rows:
+        failed = [facet for facet, passed in zip(FACETS, passes) if not passed]
+        values = dict(zip(FACETS, (make, condition, year, price_bucket, mileage_bucket)))
+        for facet in failed or FACETS:
+            bucket = counts[facet]
+            bucket[values[facet]] = bucket.get(values[facet], 0) + count
+    return counts
+
+
+def _bucket_list(counts, bounds):
+    uppers = list(bounds[1:]) + [None]
+    return [{'min': bound, 'max': upper, 'count': counts[bound]}
+            for bound, upper in zip(bounds, uppers) if counts.get(bound)]
+
+
+def format_facets(counts):
+    by_count = lambda items: sorted(items, key=lambda item: (-item[1], str(item[0])))
+    return {
+        'make': [{'value': value, 'count': count} for value, count in by_count(counts['make'].items())],
+        'condition': [{'value': value, 'count': count}
+                      for value, count in by_count(counts['condition'].items()) if value],
+        'year': [{'value': value, 'count': count}
+                 for value, count in sorted(counts['year'].items(), reverse=True)],
+        'price': _bucket_list(counts['price'], PRICE_BUCKETS),
+        'mileage': _bucket_list(counts['mileage'], MILEAGE_BUCKETS),
+    }
@@ -0,0 +1,66 @@
+import os
+import signal
+import threading
+
+# gunicorn -c gunicorn.conf.py wsgi:app
+bind = os.environ.get('MAWATER_BIND', '0.0.0.0:8000')
+
+# Worker processes share the SQLite file: WAL lets them read concurrently and
+# writers queue on the file lock for up to MAWATER_DB_BUSY_TIMEOUT_MS. Each
+# process has its own connection pool, caches and metrics.
+workers = int(os.environ.get('MAWATER_WORKERS', str(os.cpu_count() or 1)))
+# gevent (the default when installed) serves each request on a greenlet, so
+# an open /api/messages/stream costs a socket while it waits instead of a
+# thread. SQLite calls do not yield, so a worker runs one query at a time;
+# add workers rather than connections for query throughput.
+try:
+    import gevent
+except ImportError:
+    gevent = None
+worker_class = os.environ.get('MAWATER_WORKER_CLASS', 'gevent' if gevent else 'gthread')
+if worker_class == 'gevent':
+    # Patched here, before the app is preloaded, so the locks, conditions and
+    # events it creates at import (pools, queues, the message hub) cooperate
+    from gevent import monkey
+    monkey.patch_all()
+    worker_connections = int(os.environ.get('MAWATER_WORKER_CONNECTIONS', '1000'))
+# gthread: one thread per pooled connection, so requests never queue for a
+# connection. Each open stream holds one of these threads until the client
+# disconnects, so streams are capped at threads // 4 per worker (events.py)
+# and the rest are refused with a 503.
+threads = int(os.environ.get('MAWATER_THREADS', os.environ.get('MAWATER_DB_POOL_SIZE', '8')))
+
+# Import the app (and migrate) once in the master before forking. This also
+# gives every worker the same random secret when MAWATER_SECRET_KEY is unset,
+# though tokens then still stop working on restart; set it in production.
+preload_app = True
+
+# On SIGTERM workers stop accepting, finish in-flight requests and run
+# shutdown() within this many seconds. Open message streams are in-flight
+# requests too, so post_worker_init ends them as soon as SIGTERM arrives.
+graceful_timeout = int(os.environ.get('MAWATER_GRACEFUL_TIMEOUT', '30'))
+timeout = int(os.environ.get('MAWATER_WORKER_TIMEOUT', '60'))
+keepalive = 5
+accesslog = os.environ.get('MAWATER_ACCESS_LOG', '-') or None
+
+
+def post_worker_init(worker):
+    handle_exit = worker.handle_exit
+
+    def handle_term(sig, frame):
+        # Closing the hub wakes every stream, which then returns, so the
+        # drain does not sit out graceful_timeout. It takes the hub's lock,
+        # so it runs off the signal handler, on a greenlet under gevent
+        from app import message_hub
+        if worker_class == 'gevent':
+            gevent.spawn(message_hub.close)
+        else:
+            threading.Thread(target=message_hub.close, name='close-streams', daemon=True).start()
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+
+def worker_exit(server, worker):
+    from app import shutdown
+    shutdown()
@@ -0,0 +1,178 @@
+import functools
+import gzip
+import hashlib
+import os
+import threading
+from collections import defaultdict
+
+from flask import current_app, g, request
+
+from db import get_db
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is always available
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get('MAWATER_COMPRESS_MIN_BYTES', '1024'))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+ENCODING_SUFFIXES = ('-br', '-gzip')
+
+_lock = threading.Lock()
+_stats = defaultdict(lambda: {
+    'responses': 0,
+    'not_modified': 0,
+    'compressed': 0,
+    'bytes_uncompressed': 0,
+    'bytes_sent': 0,
+})
+
+
+def resource_version(resource, scope_id=0):
+    row = get_db().execute(
+        "SELECT version FROM resource_versions WHERE resource = ? AND scope_id = ?",
+        (resource, scope_id)).fetchone()
+    return row[0] if row else 0
+
+
+def make_etag(resource, scope_id, version):
+    # The body is fully determined by the resource version and the request
+    # URL (filters, cursor, user), so together they make a strong validator.
+    # ETAG_SALT changes with the response format so old tags stop matching.
+    salt = current_app.config.get('ETAG_SALT', '')
+    raw = f'{salt}:{resource}:{scope_id}:{version}:{request.full_path}'
+    return hashlib.sha1(raw.encode()).hexdigest()[:24]
+
+
+def _scope_id(name, view_args):
+    if callable(name):
+        return name()
+    return int(view_args.get(name, request.args.get(name)))
+
+
+def conditional_get(resource, scope=None, depends_on=(), writes=False):
+    # Answers GETs with 304 Not Modified when the client's If-None-Match still
+    # matches the resource version, before the view runs its query. scope names
+    # the view or query argument identifying whose copy of the resource it is,
+    # or is a function of the request returning that id.
+    # depends_on lists optional (resource, argument) pairs whose versions also
+    # feed the ETag when that argument is present in the request. argument may
+    # also be a function of the request returning the scope id, or None.
+    # Views that may change the resource themselves (writes=True) are tagged
+    # with the version read after they ran; the rest reuse the one read before.
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+            scope_id = 0
+            if scope:
+                try:
+                    scope_id = _scope_id(scope, kwargs)
+                except (TypeError, ValueError):
+                    return view(*args, **kwargs)
+            extras = []
+            for extra_resource, argument in depends_on:
+                try:
+                    extra_scope = _scope_id(argument, kwargs)
+                except (TypeError, ValueError):
+                    continue
+                if extra_scope is not None:
+                    extras.append((extra_resource, extra_scope))
+
+            def current_version():
+                versions = [resource_version(resource, scope_id)]
+                versions += [resource_version(name, extra_scope) for name, extra_scope in extras]
+                return '.'.join(str(version) for version in versions)
+
+            # Kept for views that key their own caches on it (see cars())
+            g.resource_version = current_version()
+            etag = make_etag(resource, scope_id, g.resource_version)
+            for suffix in ('',) + ENCODING_SUFFIXES:
+                if request.if_none_match.contains(etag + suffix):
+                    response = current_app.response_class(status=304)
+                    response.set_etag(etag + suffix)
+                    response.headers['Cache-Control'] = 'no-cache'
+                    return response
+
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(make_etag(resource, scope_id, current_version()) if writes else etag)
+                # Let browsers keep the body but revalidate it on every fetch
+                response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+def _negotiate_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_response(response):
+    # Compresses eligible JSON bodies in place and returns the size before
+    # compression (None when the response was left untouched)
+    if response.direct_passthrough or response.is_streamed \
+            or response.status_code != 200 or 'Content-Encoding' in response.headers \
+            or response.mimetype != 'application/json':
+        return None
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return None
+    response.vary.add('Accept-Encoding')
+    encoding = _negotiate_encoding()
+    if encoding is None:
+        return None
+
+    if encoding == 'br':
+        compressed = brotli.compress(body, quality=BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(body, compresslevel=GZIP_LEVEL)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # A different byte representation needs a different strong ETag
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(f'{etag}-{encoding}')
+    return len(body)
+
+
+def record_response(response, uncompressed=None):
+    if not request.endpoint:
+        return
+    with _lock:
+        stats = _stats[request.endpoint]
+        stats['responses'] += 1
+        if response.status_code == 304:
+            stats['not_modified'] += 1
+        elif not response.is_streamed:
+            sent = response.calculate_content_length() or 0
+            stats['bytes_sent'] += sent
+            stats['bytes_uncompressed'] += uncompressed if uncompressed is not None else sent
+            if uncompressed is not None:
+                stats['compressed'] += 1
+
+
+def init_app(app):
+    @app.after_request
+    def compress_and_record(response):
+        record_response(response, compress_response(response))
+        return response
+
+
+def stats():
+    with _lock:
+        report = {}
+        for endpoint, counters in sorted(_stats.items()):
+            report[endpoint] = dict(counters)
+            report[endpoint]['bytes_saved'] = counters['bytes_uncompressed'] - counters['bytes_sent']
+            report[endpoint]['not_modified_ratio'] = round(
+                counters['not_modified'] / counters['responses'], 4) if counters['responses'] else 0.0
+        return report
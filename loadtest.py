@@ -0,0 +1,392 @@
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import db
+import migrations
+import passwords
+
+# Dataset sizes for `flask seed-benchmark`; override per run on the CLI
+DEFAULT_SIZES = {'users': 50000, 'cars': 100000, 'messages': 1000000, 'favorites': 500000}
+SEED_BATCH_SIZE = 10000
+BENCHMARK_PASSWORD = 'benchmark'
+
+MODELS = {
+    'Toyota': ('Land Cruiser', 'Camry', 'Corolla', 'Hilux', 'Prado', 'RAV4'),
+    'Nissan': ('Patrol', 'Altima', 'Sunny', 'X-Trail', 'Navara'),
+    'Lexus': ('LX 600', 'ES 350', 'RX 350', 'GX 460'),
+    'Mercedes-Benz': ('G 63', 'S 500', 'E 300', 'C 200'),
+    'BMW': ('X5', 'X7', '530i', '740Li'),
+    'Ford': ('F-150', 'Explorer', 'Mustang', 'Expedition'),
+    'Hyundai': ('Tucson', 'Elantra', 'Santa Fe', 'Sonata'),
+    'Kia': ('Sportage', 'Sorento', 'K5', 'Telluride'),
+    'Chevrolet': ('Tahoe', 'Silverado', 'Camaro', 'Traverse'),
+    'Porsche': ('Cayenne', '911', 'Macan', 'Panamera'),
+}
+CONDITIONS = ('new', 'excellent', 'good', 'fair', 'poor')
+# Status mix of a live marketplace: mostly approved, a moderation backlog
+STATUSES = (('approved', 85), ('pending', 10), ('rejected', 5))
+WORDS = ('clean', 'one owner', 'full service history', 'agency maintained', 'low mileage',
+         'sunroof', 'leather seats', 'under warranty', 'accident free', 'GCC specs',
+         'new tyres', 'family car', 'urgent sale', 'negotiable', 'first owner')
+MESSAGES = ('Is this still available?', 'What is your best price?', 'Can I see it tomorrow?',
+            'Any accidents?', 'Yes, still available.', 'Price is negotiable.',
+            'Service history is complete.', 'Thanks, I will think about it.')
+
+LATENCY_PERCENTILES = (50, 95, 99)
+
+
+def _timestamp(rng, start, span_seconds):
+    return (start + timedelta(seconds=rng.randrange(span_seconds))).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _batches(rows, size=SEED_BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _users(rng, count, password):
+    for i in range(count):
+        yield (f'User{i}', f'Bench{i % 997}', f'user{i}@bench.mawater', password,
+               f'+974 5{rng.randrange(10000000):07d}')
+
+
+def _cars(rng, count, user_ids, start):
+    makes = list(MODELS)
+    statuses = [status for status, weight in STATUSES for _ in range(weight)]
+    for _ in range(count):
+        make = rng.choice(makes)
+        year = rng.randint(2000, 2025)
+        age = 2025 - year
+        price = round(rng.uniform(15000, 400000) * (0.93 ** age), -2)
+        mileage = None if rng.random() < 0.05 else int(age * rng.uniform(8000, 30000))
+        description = ', '.join(rng.sample(WORDS, 4)).capitalize() + '.'
+        yield (make, rng.choice(MODELS[make]), year, price, mileage, rng.choice(CONDITIONS),
+               description, rng.choice(user_ids), rng.choice(statuses),
+               _timestamp(rng, start, 730 * 86400))
+
+
+def _messages(rng, count, user_ids, car_ids, start):
+    # Conversations of a few messages each between a buyer and a seller,
+    # inserted in time order so ids and timestamps agree
+    span = 365 * 86400
+    step = max(span // max(count, 1), 1)
+    sent = 0
+    while sent < count:
+        buyer, seller = rng.sample(user_ids, 2)
+        car_id = rng.choice(car_ids)
+        for turn in range(min(rng.randint(1, 8), count - sent)):
+            sender, receiver = (buyer, seller) if turn % 2 == 0 else (seller, buyer)
+            created = (start + timedelta(seconds=sent * step)).strftime('%Y-%m-%d %H:%M:%S')
+            read = 0 if rng.random() < 0.1 else 1
+            yield (sender, receiver, car_id, rng.choice(MESSAGES), read, created)
+            sent += 1
+
+
+def _favorites(rng, count, user_ids, car_ids, start):
+    seen = set()
+    count = min(count, len(user_ids) * len(car_ids))
+    while len(seen) < count:
+        pair = (rng.choice(user_ids), rng.choice(car_ids))
+        if pair not in seen:
+            seen.add(pair)
+            yield pair + (_timestamp(rng, start, 365 * 86400),)
+
+
+def seed(path, sizes=None, seed_value=0, progress=print):
+    # Builds a benchmark database at path: the current schema plus synthetic
+    # users, cars, messages and favorites. Rows go in through the normal
+    # triggers, so summaries, counters and the search index are consistent.
+    if os.path.exists(path):
+        raise FileExistsError(f'{path} already exists; seed into a new file')
+    sizes = dict(DEFAULT_SIZES, **(sizes or {}))
+    rng = random.Random(seed_value)
+    now = datetime(2025, 6, 1)
+    conn = db.connect(path)
+    try:
+        # A throwaway database: durability does not matter while loading it
+        conn.execute('PRAGMA synchronous = OFF')
+        migrations.migrate(conn)
+        # Every benchmark user shares one password, hashed once
+        password = passwords._hash(BENCHMARK_PASSWORD, passwords.PASSWORD_METHOD)
+        tables = (
+            ('users', "INSERT INTO users (firstName, lastName, email, password, phone) VALUES (?, ?, ?, ?, ?)",
+             lambda: _users(rng, sizes['users'], password)),
+            ('cars', """INSERT INTO cars (make, model, year, price, mileage, condition, description,
+                                          user_id, status, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+             lambda: _cars(rng, sizes['cars'], user_ids, now - timedelta(days=730))),
+            ('messages', """INSERT INTO messages (sender_id, receiver_id, car_id, message, read, created_at)
+                            VALUES (?, ?, ?, ?, ?, ?)""",
+             lambda: _messages(rng, sizes['messages'], user_ids, car_ids, now - timedelta(days=365))),
+            ('favorites', "INSERT INTO favorites (user_id, car_id, created_at) VALUES (?, ?, ?)",
+             lambda: _favorites(rng, sizes['favorites'], user_ids, car_ids, now - timedelta(days=365))),
+        )
+        user_ids = car_ids = None
+        for table, sql, rows in tables:
+            start = time.perf_counter()
+            inserted = 0
+            for batch in _batches(rows()):
+                conn.executemany(sql, batch)
+                conn.commit()
+                inserted += len(batch)
+            progress(f'{table}: {inserted} rows in {time.perf_counter() - start:.1f}s')
+            if table == 'users':
+                user_ids = [row[0] for row in conn.execute("SELECT id FROM users WHERE is_admin = 0")]
+            elif table == 'cars':
+                car_ids = [row[0] for row in conn.execute("SELECT id FROM cars WHERE status = 'approved'")]
+        conn.execute('ANALYZE')
+        conn.commit()
+    finally:
+        conn.close()
+    return sizes
+
+
+class Context:
+    # Ids and values sampled from the database under test, so requests hit
+    # rows that exist and parameters vary the way real traffic does
+
+    def __init__(self, conn, sample_size=1000, seed_value=0):
+        rng = random.Random(seed_value)
+
+        def sample(sql):
+            rows = conn.execute(sql).fetchall()
+            return rng.sample(rows, min(sample_size, len(rows)))
+        self.admin_id = conn.execute("SELECT id FROM users WHERE is_admin = 1 ORDER BY id LIMIT 1").fetchone()[0]
+        self.users = [row[0] for row in sample("SELECT id FROM users ORDER BY id")]
+        self.sellers = [row[0] for row in sample(
+            "SELECT DISTINCT user_id FROM cars WHERE user_id IS NOT NULL ORDER BY user_id")]
+        self.favoriters = [row[0] for row in sample(
+            "SELECT DISTINCT user_id FROM favorites ORDER BY user_id")] or self.users
+        self.conversations = sample(
+            "SELECT user_id, other_user_id FROM conversations ORDER BY user_id, other_user_id")
+        self.cars = [row[0] for row in sample("SELECT id FROM cars WHERE status = 'approved' ORDER BY id")]
+        self.makes = [row[0] for row in conn.execute("SELECT DISTINCT make FROM cars")] or list(MODELS)
+
+
+def _car_search(sort_by):
+    def request(rng, ctx):
+        params = {'sort_by': sort_by, 'sort_order': rng.choice(('ASC', 'DESC'))}
+        if rng.random() < 0.5:
+            params['make'] = rng.choice(ctx.makes)
+        if rng.random() < 0.3:
+            low = rng.randrange(5000, 200000, 5000)
+            params['price_min'], params['price_max'] = low, low + rng.choice((20000, 50000, 100000))
+        if rng.random() < 0.3:
+            params['year_min'] = rng.randint(2005, 2022)
+        if rng.random() < 0.2 and ctx.users:
+            params['include_favorites_for'] = rng.choice(ctx.users)
+        return '/api/cars?' + urllib.parse.urlencode(params)
+    return request
+
+
+def _text_search(rng, ctx):
+    make = rng.choice(ctx.makes)
+    return '/api/cars?' + urllib.parse.urlencode({'q': f'{make} {rng.choice(MODELS.get(make, ("",)))}'.strip()})
+
+
+def _as(user_id, path, method='GET', body=None):
+    return method, path, body, user_id
+
+
+def _conversation(rng, ctx):
+    user_id, other_id = rng.choice(ctx.conversations)
+    return _as(user_id, f'/api/messages/{other_id}')
+
+
+# name -> builds the path for one request, or (method, path, JSON body) and
+# optionally the user it is made as, who then sends their token
+SCENARIOS = {
+    'cars: newest': _car_search('created_at'),
+    'cars: by price': _car_search('price'),
+    'cars: by year': _car_search('year'),
+    'cars: by mileage': _car_search('mileage'),
+    'cars: text search': _text_search,
+    'cars: facets': lambda rng, ctx: f'/api/cars/facets?make={urllib.parse.quote(rng.choice(ctx.makes))}',
+    'car: detail': lambda rng, ctx: f'/api/cars/{rng.choice(ctx.cars)}',
+    'messages: inbox': lambda rng, ctx: _as(rng.choice(ctx.conversations)[0], '/api/messages'),
+    'messages: conversation': _conversation,
+    'my-cars': lambda rng, ctx: _as(rng.choice(ctx.sellers), '/api/my-cars'),
+    'favorites': lambda rng, ctx: _as(rng.choice(ctx.favoriters), '/api/favorites'),
+    'admin: pending cars': lambda rng, ctx: _as(ctx.admin_id, '/api/admin/cars?status=pending'),
+    'admin: queue': lambda rng, ctx: _as(
+        ctx.admin_id, f"/api/admin/queue?status={rng.choice(('pending', 'approved', 'rejected'))}"),
+}
+
+
+def _send_message(rng, ctx):
+    user_id, other_id = rng.choice(ctx.conversations)
+    return _as(user_id, '/api/messages', 'POST', {'receiver_id': other_id, 'message': rng.choice(MESSAGES)})
+
+
+def _add_favorite(rng, ctx):
+    # Random pairs; the odd duplicate is answered with a 400
+    return _as(rng.choice(ctx.users), '/api/favorites', 'POST', {'car_id': rng.choice(ctx.cars)})
+
+
+def _impressions(rng, ctx):
+    # One search page's worth of cards
+    return 'POST', '/api/cars/impressions', {'car_ids': rng.sample(ctx.cars, min(20, len(ctx.cars)))}
+
+
+# Write scenarios build a request like the rest but only run when named,
+# since they change the database under test
+WRITE_SCENARIOS = {
+    'write: send message': _send_message,
+    'write: add favorite': _add_favorite,
+    'write: impressions': _impressions,
+}
+SCENARIOS.update(WRITE_SCENARIOS)
+READ_SCENARIOS = [name for name in SCENARIOS if name not in WRITE_SCENARIOS]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def _summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        'max_ms': round(latencies[-1], 3) if latencies else 0.0,
+    }
+    for pct in LATENCY_PERCENTILES:
+        summary[f'p{pct}_ms'] = round(percentile(latencies, pct), 3)
+    return summary
+
+
+def _test_client_sender(app):
+    # One test client per worker thread
+    local = threading.local()
+
+    def send(method, path, body, headers):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        response = local.client.open(path, method=method, json=body, headers=headers)
+        response.close()
+        return response.status_code
+    return send
+
+
+def _http_sender(base_url):
+    def send(method, path, body, headers):
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers = dict(headers, **{'Content-Type': 'application/json'})
+        request = urllib.request.Request(base_url.rstrip('/') + path, data, headers, method=method)
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+    return send
+
+
+def run(app, ctx, scenarios=None, requests=200, concurrency=8, base_url=None, seed_value=0,
+        token_for=None, progress=print):
+    # Drives each scenario in turn with `requests` requests spread over
+    # `concurrency` threads, through the test client or a running server.
+    # token_for(user_id) signs the requests made as a user.
+    send = _http_sender(base_url) if base_url else _test_client_sender(app)
+    names = scenarios or READ_SCENARIOS
+    results = {}
+    for name in names:
+        rng = random.Random(f'{seed_value}:{name}')
+        build = SCENARIOS[name]
+        calls = []
+        for _ in range(requests):
+            call = build(rng, ctx)
+            method, path, body, *user = ('GET', call, None) if isinstance(call, str) else call
+            headers = {'Authorization': f'Bearer {token_for(user[0])}'} if user else {}
+            calls.append((method, path, body, headers))
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+
+        def one(call):
+            nonlocal errors
+            start = time.perf_counter()
+            try:
+                status = send(*call)
+            except Exception:
+                status = None
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed_ms)
+                if status is None or status >= 400:
+                    errors += 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(one, calls))
+        results[name] = _summarize(latencies, errors, time.perf_counter() - start)
+        progress(format_result(name, results[name]))
+    return results
+
+
+def dataset_counts(conn):
+    return {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ('users', 'cars', 'messages', 'favorites')}
+
+
+def report(results, dataset, concurrency, requests, target):
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'target': target,
+        'concurrency': concurrency,
+        'requests_per_endpoint': requests,
+        'dataset': dataset,
+        'endpoints': results,
+    }
+
+
+def format_result(name, result):
+    return (f"{name:24} {result['throughput_rps']:8.1f} req/s  p50 {result['p50_ms']:8.2f}  "
+            f"p95 {result['p95_ms']:8.2f}  p99 {result['p99_ms']:8.2f} ms  errors {result['errors']}")
+
+
+def compare(previous, current):
+    # Lines describing how each endpoint moved relative to an earlier report
+    lines = []
+    for name, result in current['endpoints'].items():
+        before = previous.get('endpoints', {}).get(name)
+        if not before:
+            lines.append(f'{name:24} (new)')
+            continue
+        changes = []
+        for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            if before[key]:
+                changes.append(f'{key} {(result[key] - before[key]) * 100 / before[key]:+.1f}%')
+        lines.append(f"{name:24} {'  '.join(changes)}")
+    return lines
+
+
+def save(data, path):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,346 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+from flask import g, has_request_context, request
+
+# Off: connections are plain sqlite3 connections and no request hooks run
+ENABLED = os.environ.get('MAWATER_METRICS', '1') == '1'
+SLOW_QUERY_MS = float(os.environ.get('MAWATER_SLOW_QUERY_MS', '100'))
+SLOW_QUERY_LOG_SIZE = 100
+# Slow queries are logged with their parameters' types only; bound values
+# include emails, password hashes and, during a rehash, plaintext passwords.
+# 1 shows values, except for statements on the users table.
+SLOW_QUERY_PARAMS = os.environ.get('MAWATER_SLOW_QUERY_PARAMS', '0') == '1'
+# Statements are labelled by their SQL text; dynamically built SQL beyond
+# this many distinct statements is counted under one label
+MAX_STATEMENTS = 500
+STATEMENT_LABEL_CHARS = 300
+
+# Histogram upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+_WHITESPACE = re.compile(r'\s+')
+_USERS_TABLE = re.compile(r'\busers\b', re.IGNORECASE)
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}      # (endpoint, method) -> Histogram
+        self.responses = {}     # (endpoint, method, status) -> count
+        self.request_queries = {}   # endpoint -> Histogram of statements per request
+        self.statements = {}    # label -> [count, seconds, max seconds]
+        self.query_latency = Histogram()
+        self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+        self.slow_query_count = 0
+        self.statement_cache_hits = 0
+        self.statement_cache_misses = 0
+        self._labels = {}       # raw SQL -> label
+
+    def statement_label(self, sql):
+        label = self._labels.get(sql)
+        if label is None:
+            label = _WHITESPACE.sub(' ', sql).strip()
+            if _USERS_TABLE.search(label):
+                # Seed and migration statements on users carry values as literals
+                label = _STRING_LITERAL.sub("'?'", label)
+            label = label[:STATEMENT_LABEL_CHARS]
+            with self._lock:
+                if len(self._labels) < MAX_STATEMENTS * 4:
+                    self._labels[sql] = label
+        return label
+
+    def record_query(self, sql, seconds):
+        label = self.statement_label(sql)
+        with self._lock:
+            stats = self.statements.get(label)
+            if stats is None:
+                if len(self.statements) >= MAX_STATEMENTS:
+                    label = 'other'
+                stats = self.statements.setdefault(label, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            self.query_latency.observe(seconds)
+
+    def record_slow_query(self, entry):
+        with self._lock:
+            self.slow_queries.append(entry)
+            self.slow_query_count += 1
+
+    def record_request(self, endpoint, method, status, seconds, queries):
+        with self._lock:
+            histogram = self.requests.get((endpoint, method))
+            if histogram is None:
+                histogram = self.requests[(endpoint, method)] = Histogram()
+            histogram.observe(seconds)
+            key = (endpoint, method, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+            histogram = self.request_queries.get(endpoint)
+            if histogram is None:
+                histogram = self.request_queries[endpoint] = Histogram(QUERY_COUNT_BUCKETS)
+            histogram.observe(queries)
+
+    def record_statement_cache(self, hit):
+        with self._lock:
+            if hit:
+                self.statement_cache_hits += 1
+            else:
+                self.statement_cache_misses += 1
+
+    def statement_cache_stats(self):
+        with self._lock:
+            lookups = self.statement_cache_hits + self.statement_cache_misses
+            return {
+                'hits': self.statement_cache_hits,
+                'misses': self.statement_cache_misses,
+                'hit_rate': round(self.statement_cache_hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def slow_query_log(self):
+        with self._lock:
+            return list(reversed(self.slow_queries))
+
+
+registry = Registry()
+
+
+def _explain(conn, sql, params):
+    try:
+        rows = sqlite3.Connection.execute(conn, f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+        return [row[-1] for row in rows]
+    except sqlite3.Error as e:
+        return [f'unavailable: {str(e)}']
+
+
+def _describe_params(sql, params):
+    if not isinstance(params, (list, tuple)):
+        # Named parameters
+        params = list(params.values()) if isinstance(params, dict) else [params]
+    if SLOW_QUERY_PARAMS and not _USERS_TABLE.search(sql):
+        return [repr(param) for param in params]
+    return [f'<{type(param).__name__}>' for param in params]
+
+
+def _observe(cursor, sql, params, seconds, plan=True):
+    registry.record_query(sql, seconds)
+    if has_request_context():
+        g.metrics_queries = g.get('metrics_queries', 0) + 1
+        g.metrics_sql_seconds = g.get('metrics_sql_seconds', 0.0) + seconds
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        entry = {
+            'ms': round(seconds * 1000, 3),
+            'sql': registry.statement_label(sql),
+            'params': _describe_params(sql, params),
+            'plan': _explain(cursor.connection, sql, params) if plan else [],
+            'endpoint': request.endpoint if has_request_context() else None,
+        }
+        registry.record_slow_query(entry)
+        print(f"Slow query ({entry['ms']} ms) in {entry['endpoint']}: {entry['sql']} "
+              f"params={entry['params']} plan={entry['plan']}")
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Times execute() and the fetch that follows it; SQLite does most of a
+    # SELECT's work while rows are stepped, so fetch time is charged to the
+    # statement that produced the rows. Plain iteration is not timed.
+
+    def execute(self, sql, params=()):
+        _lookup_statement(self.connection, sql)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._sql = sql
+            _observe(self, sql, params, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_params):
+        _lookup_statement(self.connection, sql)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            self._sql = None
+            _observe(self, sql, (), time.perf_counter() - start, plan=False)
+
+    def _timed_fetch(self, fetch, *args):
+        sql = getattr(self, '_sql', None)
+        if sql is None:
+            return fetch(*args)
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            seconds = time.perf_counter() - start
+            _charge_fetch(sql, seconds)
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed_fetch(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+
+def _charge_fetch(sql, seconds):
+    # Adds fetch time to the statement without counting another execution
+    label = registry.statement_label(sql)
+    with registry._lock:
+        stats = registry.statements.get(label) or registry.statements.get('other')
+        if stats is not None:
+            stats[1] += seconds
+    if has_request_context():
+        g.metrics_sql_seconds = g.get('metrics_sql_seconds', 0.0) + seconds
+
+
+def _lookup_statement(conn, sql):
+    # The driver keeps an LRU of prepared statements per connection keyed by
+    # the SQL text; this mirrors it to count how often a statement is reused
+    # instead of prepared again
+    cache = getattr(conn, '_statements', None)
+    if cache is None:
+        return
+    hit = sql in cache
+    if hit:
+        cache.move_to_end(sql)
+    else:
+        cache[sql] = None
+        if len(cache) > conn._statement_cache_size:
+            cache.popitem(last=False)
+    registry.record_statement_cache(hit)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def __init__(self, *args, cached_statements=128, **kwargs):
+        super().__init__(*args, cached_statements=cached_statements, **kwargs)
+        self._statements = OrderedDict()
+        self._statement_cache_size = cached_statements
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def connection_factory():
+    return InstrumentedConnection if ENABLED else sqlite3.Connection
+
+
+def init_app(app):
+    if not ENABLED:
+        return
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_timing(response):
+        start = g.pop('metrics_start', None)
+        if start is not None and request.endpoint:
+            seconds = time.perf_counter() - start
+            queries = g.pop('metrics_queries', 0)
+            sql_seconds = g.pop('metrics_sql_seconds', 0.0)
+            registry.record_request(request.endpoint, request.method, response.status_code, seconds, queries)
+            response.headers.add('Server-Timing', f'db;dur={sql_seconds * 1000:.2f};desc="{queries} queries"')
+            response.headers.add('Server-Timing', f'total;dur={seconds * 1000:.2f}')
+        return response
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _histogram_lines(name, histogram, **labels):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {cumulative}')
+    lines.append(f'{name}_bucket{_labels(**labels, le="+Inf")} {histogram.count}')
+    suffix = _labels(**labels) if labels else ''
+    lines.append(f'{name}_sum{suffix} {histogram.sum}')
+    lines.append(f'{name}_count{suffix} {histogram.count}')
+    return lines
+
+
+def render(gauges=None):
+    # Prometheus text exposition format. gauges maps a prefix to one of the
+    # stats() dicts; its numeric values are exported as mawater_<prefix>_<key>.
+    lines = []
+    with registry._lock:
+        lines += ['# HELP mawater_request_duration_seconds Time spent handling requests.',
+                  '# TYPE mawater_request_duration_seconds histogram']
+        for (endpoint, method), histogram in sorted(registry.requests.items()):
+            lines += _histogram_lines('mawater_request_duration_seconds', histogram,
+                                      endpoint=endpoint, method=method)
+        lines += ['# HELP mawater_responses_total Responses by endpoint and status code.',
+                  '# TYPE mawater_responses_total counter']
+        for (endpoint, method, status), count in sorted(registry.responses.items()):
+            lines.append(f'mawater_responses_total{_labels(endpoint=endpoint, method=method, status=status)} {count}')
+        lines += ['# HELP mawater_request_queries SQL statements executed per request.',
+                  '# TYPE mawater_request_queries histogram']
+        for endpoint, histogram in sorted(registry.request_queries.items()):
+            lines += _histogram_lines('mawater_request_queries', histogram, endpoint=endpoint)
+        lines += ['# HELP mawater_sql_duration_seconds Time per SQL statement, all statements.',
+                  '# TYPE mawater_sql_duration_seconds histogram']
+        lines += _histogram_lines('mawater_sql_duration_seconds', registry.query_latency)
+        lines += ['# HELP mawater_sql_statements_total Executions per SQL statement.',
+                  '# TYPE mawater_sql_statements_total counter']
+        statements = sorted(registry.statements.items())
+        for statement, (count, _, _) in statements:
+            lines.append(f'mawater_sql_statements_total{_labels(statement=statement)} {count}')
+        lines += ['# HELP mawater_sql_statement_seconds_total Time per SQL statement, including fetches.',
+                  '# TYPE mawater_sql_statement_seconds_total counter']
+        for statement, (_, seconds, _) in statements:
+            lines.append(f'mawater_sql_statement_seconds_total{_labels(statement=statement)} {seconds}')
+        lines += ['# HELP mawater_sql_statement_max_seconds Slowest single execution per SQL statement.',
+                  '# TYPE mawater_sql_statement_max_seconds gauge']
+        for statement, (_, _, slowest) in statements:
+            lines.append(f'mawater_sql_statement_max_seconds{_labels(statement=statement)} {slowest}')
+        lines += ['# HELP mawater_slow_queries_total Statements slower than MAWATER_SLOW_QUERY_MS.',
+                  '# TYPE mawater_slow_queries_total counter',
+                  f'mawater_slow_queries_total {registry.slow_query_count}']
+        lines += ['# HELP mawater_statement_cache_lookups_total Statements reused from or added to the '
+                  'prepared statement cache.',
+                  '# TYPE mawater_statement_cache_lookups_total counter',
+                  f'mawater_statement_cache_lookups_total{_labels(result="hit")} {registry.statement_cache_hits}',
+                  f'mawater_statement_cache_lookups_total{_labels(result="miss")} {registry.statement_cache_misses}']
+    for prefix, stats in (gauges or {}).items():
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = f'mawater_{prefix}_{key}'
+                lines += [f'# TYPE {name} gauge', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,617 @@
+import sqlite3
+
+_UPSERT_VERSION = 'ON CONFLICT (resource, scope_id) DO UPDATE SET version = version + 1;'
+
+
+def _bump(resource, scope, condition='1'):
+    return (f"INSERT INTO resource_versions (resource, scope_id, version) "
+            f"SELECT '{resource}', {scope}, 1 WHERE {condition} {_UPSERT_VERSION}")
+
+
+def _bump_favoriters(car_id):
+    # Everyone who favorited the car sees it in their /api/favorites list
+    return (f"INSERT INTO resource_versions (resource, scope_id, version) "
+            f"SELECT 'favorites', user_id, 1 FROM favorites WHERE car_id = {car_id} {_UPSERT_VERSION}")
+
+
+def _bump_owner(car_id):
+    # The seller's /api/my-cars shows a favorite count per car
+    return (f"INSERT INTO resource_versions (resource, scope_id, version) "
+            f"SELECT 'my-cars', user_id, 1 FROM cars "
+            f"WHERE id = {car_id} AND user_id IS NOT NULL {_UPSERT_VERSION}")
+
+
+def _count_status(status, delta):
+    return (f"INSERT INTO car_status_counts (status, count) "
+            f"SELECT {status}, {delta} WHERE {status} IS NOT NULL "
+            f"ON CONFLICT (status) DO UPDATE SET count = count + {delta};")
+
+
+# Lower bounds of the facet buckets. Changing them needs a migration that
+# rebuilds car_facets.
+PRICE_BUCKETS = (0, 5000, 10000, 15000, 20000, 30000, 50000, 75000, 100000)
+MILEAGE_BUCKETS = (0, 10000, 25000, 50000, 100000, 150000, 200000)
+NO_MILEAGE = -1
+
+
+def bucket_sql(column, bounds, missing=None):
+    cases = ' '.join(f'WHEN {column} >= {bound} THEN {bound}' for bound in reversed(bounds[1:]))
+    if missing is not None:
+        cases = f'WHEN {column} IS NULL THEN {missing} {cases}'
+    return f'(CASE {cases} ELSE {bounds[0]} END)'
+
+
+FACET_KEY = ('make', 'model', 'condition', 'year', 'price_bucket', 'mileage_bucket')
+
+
+def facet_values(row):
+    # A cars row (new.* or old.*) as the car_facets key columns
+    return (f"{row}.make, {row}.model, IFNULL({row}.condition, ''), {row}.year, "
+            f"{bucket_sql(f'{row}.price', PRICE_BUCKETS)}, "
+            f"{bucket_sql(f'{row}.mileage', MILEAGE_BUCKETS, NO_MILEAGE)}")
+
+
+def _count_facet(row, delta):
+    key = ', '.join(FACET_KEY)
+    statement = (f"INSERT INTO car_facets ({key}, count) "
+                 f"SELECT {facet_values(row)}, {delta} WHERE {row}.status = 'approved' "
+                 f"ON CONFLICT ({key}) DO UPDATE SET count = count + {delta};")
+    if delta < 0:
+        statement += (f" DELETE FROM car_facets WHERE ({key}) = ({facet_values(row)}) "
+                      f"AND count <= 0;")
+    return statement
+
+
+_CARS_UPDATE_BUMPS = f'''
+               {_bump('cars', '0', "old.status = 'approved' OR new.status = 'approved'")}
+               {_bump('car', 'new.id')}
+               {_bump('my-cars', 'old.user_id', 'old.user_id IS NOT NULL')}
+               {_bump('my-cars', 'new.user_id', 'new.user_id IS NOT NULL AND new.user_id IS NOT old.user_id')}
+               {_bump_favoriters('new.id')}'''
+
+# Listing columns whose edits change every cached copy of a car; the
+# counters added in migration 11 are kept out of this list
+CAR_CONTENT_COLUMNS = ('make', 'model', 'year', 'price', 'mileage', 'condition', 'description',
+                       'user_id', 'status')
+RECONCILE_BATCH_SIZE = 5000
+
+
+def _add_seller_stats(views, impressions):
+    return (f"INSERT INTO seller_daily_stats (user_id, day, views, impressions) "
+            f"SELECT user_id, new.day, {views}, {impressions} FROM cars "
+            f"WHERE id = new.car_id AND user_id IS NOT NULL "
+            f"ON CONFLICT (user_id, day) DO UPDATE SET "
+            f"views = views + excluded.views, impressions = impressions + excluded.impressions;")
+
+
+# Rebuilds the per-user inbox summary from the messages table. Each pair of
+# users has one row per participant, so an inbox is a single range read.
+BACKFILL_CONVERSATIONS = [
+    'DELETE FROM conversations',
+    '''INSERT INTO conversations
+           (user_id, other_user_id, car_id, last_message_id, last_message_time,
+            last_message_preview, unread_count)
+       SELECT p.user_id, p.other_user_id,
+              (SELECT car_id FROM messages cm
+               WHERE cm.car_id IS NOT NULL
+                 AND ((cm.sender_id = p.user_id AND cm.receiver_id = p.other_user_id)
+                   OR (cm.sender_id = p.other_user_id AND cm.receiver_id = p.user_id))
+               ORDER BY cm.id DESC LIMIT 1),
+              m.id, m.created_at, substr(m.message, 1, 120), p.unread_count
+       FROM (SELECT user_id, other_user_id, MAX(id) AS last_id, SUM(unread) AS unread_count
+             FROM (SELECT sender_id AS user_id, receiver_id AS other_user_id, id, 0 AS unread
+                   FROM messages
+                   UNION ALL
+                   SELECT receiver_id, sender_id, id, read = 0
+                   FROM messages)
+             GROUP BY user_id, other_user_id) p
+       JOIN messages m ON m.id = p.last_id''',
+]
+
+
+def backfill_conversations(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for statement in BACKFILL_CONVERSATIONS:
+            conn.execute(statement)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return conn.execute('SELECT COUNT(*) FROM conversations').fetchone()[0]
+
+
+def reconcile_favorite_counts(conn, batch_size=RECONCILE_BATCH_SIZE):
+    # Recounts cars.favorite_count from the favorites table in id ranges,
+    # one short write transaction per range, and returns how many cars had
+    # drifted (e.g. after favorites were edited with triggers disabled)
+    repaired = 0
+    last_id = 0
+    max_id = conn.execute('SELECT IFNULL(MAX(id), 0) FROM cars').fetchone()[0]
+    while last_id < max_id:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = conn.execute('''
+                UPDATE cars SET favorite_count = counted.n
+                FROM (SELECT c.id, (SELECT COUNT(*) FROM favorites f WHERE f.car_id = c.id) AS n
+                      FROM cars c WHERE c.id > ? AND c.id <= ?) counted
+                WHERE cars.id = counted.id AND cars.favorite_count != counted.n
+            ''', (last_id, last_id + batch_size))
+            repaired += cursor.rowcount
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        last_id += batch_size
+    return repaired
+
+
+def _upsert_conversation(user_id, other_user_id, unread):
+    # The car reference sticks to the last message that mentioned a car
+    return f'''INSERT INTO conversations
+                   (user_id, other_user_id, car_id, last_message_id, last_message_time,
+                    last_message_preview, unread_count)
+               VALUES ({user_id}, {other_user_id}, new.car_id, new.id, new.created_at,
+                       substr(new.message, 1, 120), {unread})
+               ON CONFLICT (user_id, other_user_id) DO UPDATE SET
+                   car_id = IFNULL(excluded.car_id, car_id),
+                   last_message_id = excluded.last_message_id,
+                   last_message_time = excluded.last_message_time,
+                   last_message_preview = excluded.last_message_preview,
+                   unread_count = unread_count + excluded.unread_count;'''
+
+
+# Schema history, applied in order and recorded in PRAGMA user_version.
+# Never edit a migration that has shipped; append a new one instead.
+MIGRATIONS = [
+    (1, 'initial schema', [
+        '''CREATE TABLE IF NOT EXISTS users
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            firstName TEXT NOT NULL,
+            lastName TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            phone TEXT,
+            is_admin INTEGER DEFAULT 0)''',
+        '''CREATE TABLE IF NOT EXISTS cars
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            make TEXT NOT NULL,
+            model TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            price REAL NOT NULL,
+            mileage INTEGER,
+            condition TEXT,
+            description TEXT,
+            user_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id))''',
+        '''CREATE TABLE IF NOT EXISTS favorites
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            car_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (car_id) REFERENCES cars (id),
+            UNIQUE(user_id, car_id))''',
+        '''CREATE TABLE IF NOT EXISTS messages
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            car_id INTEGER,
+            message TEXT NOT NULL,
+            read INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sender_id) REFERENCES users (id),
+            FOREIGN KEY (receiver_id) REFERENCES users (id),
+            FOREIGN KEY (car_id) REFERENCES cars (id))''',
+        # Default admin user and test user
+        '''INSERT OR IGNORE INTO users (firstName, lastName, email, password, is_admin)
+           VALUES ('Admin', 'User', 'admin@mawater974.com', 'admin', 1)''',
+        '''INSERT OR IGNORE INTO users (firstName, lastName, email, password, is_admin)
+           VALUES ('Duda', 'User', 'dudaduda336@gmail.com', 'duda123', 0)''',
+    ]),
+    (2, 'indexes for listing, favorites and message queries', [
+        'CREATE INDEX IF NOT EXISTS idx_cars_status_created ON cars (status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_cars_status_make_model ON cars (status, make, model)',
+        'CREATE INDEX IF NOT EXISTS idx_cars_status_price ON cars (status, price)',
+        'CREATE INDEX IF NOT EXISTS idx_cars_user_created ON cars (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_favorites_car ON favorites (car_id)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_pair_created ON messages (sender_id, receiver_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_receiver_read ON messages (receiver_id, read)',
+    ]),
+    (3, 'indexes for the remaining /api/cars sort keys', [
+        'CREATE INDEX IF NOT EXISTS idx_cars_status_year ON cars (status, year)',
+        'CREATE INDEX IF NOT EXISTS idx_cars_status_mileage ON cars (status, IFNULL(mileage, 0))',
+    ]),
+    # Full-text index over approved listings only. It is an external-content
+    # table reading from cars, kept in sync by triggers so every write path
+    # (including status changes from moderation) updates it.
+    (4, 'full-text search over approved listings', [
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS cars_fts USING fts5(
+               make, model, description,
+               content='cars', content_rowid='id',
+               tokenize='unicode61 remove_diacritics 2', prefix='2 3')''',
+        '''CREATE TRIGGER IF NOT EXISTS cars_fts_insert AFTER INSERT ON cars
+           WHEN new.status = 'approved' BEGIN
+               INSERT INTO cars_fts (rowid, make, model, description)
+               VALUES (new.id, new.make, new.model, new.description);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS cars_fts_delete AFTER DELETE ON cars
+           WHEN old.status = 'approved' BEGIN
+               INSERT INTO cars_fts (cars_fts, rowid, make, model, description)
+               VALUES ('delete', old.id, old.make, old.model, old.description);
+           END''',
+        # One trigger so the delete of the old row always runs before the
+        # insert of the new one (separate triggers fire in reverse order)
+        '''CREATE TRIGGER IF NOT EXISTS cars_fts_update
+           AFTER UPDATE OF make, model, description, status ON cars BEGIN
+               INSERT INTO cars_fts (cars_fts, rowid, make, model, description)
+               SELECT 'delete', old.id, old.make, old.model, old.description
+               WHERE old.status = 'approved';
+               INSERT INTO cars_fts (rowid, make, model, description)
+               SELECT new.id, new.make, new.model, new.description
+               WHERE new.status = 'approved';
+           END''',
+        '''INSERT INTO cars_fts (rowid, make, model, description)
+           SELECT id, make, model, description FROM cars WHERE status = 'approved' ''',
+    ]),
+    # Cheap per-resource version numbers for ETags. Triggers bump them on every
+    # write that can change what a GET returns, whichever path made the write.
+    (5, 'resource versions for conditional GETs', [
+        '''CREATE TABLE IF NOT EXISTS resource_versions
+           (resource TEXT NOT NULL,
+            scope_id INTEGER NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (resource, scope_id)) WITHOUT ROWID''',
+        f'''CREATE TRIGGER IF NOT EXISTS cars_versions_insert AFTER INSERT ON cars BEGIN
+               {_bump('cars', '0', "new.status = 'approved'")}
+               {_bump('my-cars', 'new.user_id', 'new.user_id IS NOT NULL')}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS cars_versions_update AFTER UPDATE ON cars BEGIN
+               {_CARS_UPDATE_BUMPS}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS cars_versions_delete AFTER DELETE ON cars BEGIN
+               {_bump('cars', '0', "old.status = 'approved'")}
+               {_bump('car', 'old.id')}
+               {_bump('my-cars', 'old.user_id', 'old.user_id IS NOT NULL')}
+               {_bump_favoriters('old.id')}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS favorites_versions_insert AFTER INSERT ON favorites BEGIN
+               {_bump('favorites', 'new.user_id')}
+               {_bump_owner('new.car_id')}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS favorites_versions_delete AFTER DELETE ON favorites BEGIN
+               {_bump('favorites', 'old.user_id')}
+               {_bump_owner('old.car_id')}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS messages_versions_insert AFTER INSERT ON messages BEGIN
+               {_bump('messages', 'new.sender_id')}
+               {_bump('messages', 'new.receiver_id')}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS messages_versions_update AFTER UPDATE ON messages BEGIN
+               {_bump('messages', 'new.sender_id')}
+               {_bump('messages', 'new.receiver_id')}
+           END''',
+    ]),
+    # Inbox summary maintained by triggers in the same transaction as the
+    # message insert or read-marking that changes it
+    (6, 'conversation summaries for the inbox', [
+        '''CREATE TABLE IF NOT EXISTS conversations
+           (user_id INTEGER NOT NULL,
+            other_user_id INTEGER NOT NULL,
+            car_id INTEGER,
+            last_message_id INTEGER NOT NULL,
+            last_message_time TIMESTAMP,
+            last_message_preview TEXT,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, other_user_id)) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_conversations_user_last ON conversations (user_id, last_message_id)',
+        f'''CREATE TRIGGER IF NOT EXISTS messages_conversations_insert AFTER INSERT ON messages BEGIN
+               {_upsert_conversation('new.sender_id', 'new.receiver_id', '0')}
+               {_upsert_conversation('new.receiver_id', 'new.sender_id', 'new.read = 0')}
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_conversations_read AFTER UPDATE OF read ON messages
+           WHEN (old.read = 0) IS NOT (new.read = 0) BEGIN
+               UPDATE conversations
+               SET unread_count = max(0, unread_count + CASE WHEN new.read = 0 THEN 1 ELSE -1 END)
+               WHERE user_id = new.receiver_id AND other_user_id = new.sender_id;
+           END''',
+    ] + BACKFILL_CONVERSATIONS),
+    # Conversation history is now paged by message id rather than sorted by
+    # created_at, so the pair index is keyed on id instead
+    (7, 'page conversation history by message id', [
+        'CREATE INDEX IF NOT EXISTS idx_messages_pair_id ON messages (sender_id, receiver_id, id)',
+        'DROP INDEX IF EXISTS idx_messages_pair_created',
+    ]),
+    # Older databases already have car_photos from the original schema; new
+    # ones get the same shape before the upload columns are added. Photo
+    # writes bump the versions of every response that lists the car's photos.
+    (8, 'photo uploads', [
+        '''CREATE TABLE IF NOT EXISTS car_photos
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            car_id INTEGER,
+            photo_path TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (car_id) REFERENCES cars(id))''',
+        'ALTER TABLE car_photos ADD COLUMN position INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS idx_car_photos_car ON car_photos (car_id, position, id)',
+        f'''CREATE TRIGGER IF NOT EXISTS car_photos_versions_insert AFTER INSERT ON car_photos BEGIN
+               {_bump('cars', '0', "(SELECT status FROM cars WHERE id = new.car_id) = 'approved'")}
+               {_bump('car', 'new.car_id')}
+               {_bump_owner('new.car_id')}
+               {_bump_favoriters('new.car_id')}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS car_photos_versions_delete AFTER DELETE ON car_photos BEGIN
+               {_bump('cars', '0', "(SELECT status FROM cars WHERE id = old.car_id) = 'approved'")}
+               {_bump('car', 'old.car_id')}
+               {_bump_owner('old.car_id')}
+               {_bump_favoriters('old.car_id')}
+           END''',
+        # Foreign keys are not enforced, so drop a deleted car's photo rows
+        # here. The files are shared by content and stay in the store.
+        '''CREATE TRIGGER IF NOT EXISTS cars_photos_delete AFTER DELETE ON cars BEGIN
+               DELETE FROM car_photos WHERE car_id = old.id;
+           END''',
+    ]),
+    # Listing counts per moderation status, so the admin queue can show them
+    # without counting the cars table on every page
+    (9, 'car counts per status', [
+        '''CREATE TABLE IF NOT EXISTS car_status_counts
+           (status TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID''',
+        f'''CREATE TRIGGER IF NOT EXISTS cars_status_counts_insert AFTER INSERT ON cars BEGIN
+               {_count_status('new.status', 1)}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS cars_status_counts_update AFTER UPDATE OF status ON cars
+           WHEN old.status IS NOT new.status BEGIN
+               {_count_status('old.status', -1)}
+               {_count_status('new.status', 1)}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS cars_status_counts_delete AFTER DELETE ON cars BEGIN
+               {_count_status('old.status', -1)}
+           END''',
+        'DELETE FROM car_status_counts',
+        '''INSERT INTO car_status_counts (status, count)
+           SELECT status, COUNT(*) FROM cars WHERE status IS NOT NULL GROUP BY status''',
+    ]),
+    # Approved listings counted per combination of the filterable fields,
+    # with price and mileage bucketed. Facet counts are sums over this table,
+    # which stays far smaller than cars and is kept current by triggers on
+    # every write path (single edits, moderation, bulk import, deletes).
+    (10, 'facet counts for listing filters', [
+        f'''CREATE TABLE IF NOT EXISTS car_facets
+           (make TEXT NOT NULL,
+            model TEXT NOT NULL,
+            condition TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            price_bucket INTEGER NOT NULL,
+            mileage_bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ({', '.join(FACET_KEY)})) WITHOUT ROWID''',
+        f'''CREATE TRIGGER IF NOT EXISTS cars_facets_insert AFTER INSERT ON cars BEGIN
+               {_count_facet('new', 1)}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS cars_facets_update
+           AFTER UPDATE OF make, model, condition, year, price, mileage, status ON cars
+           WHEN old.status = 'approved' OR new.status = 'approved' BEGIN
+               {_count_facet('old', -1)}
+               {_count_facet('new', 1)}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS cars_facets_delete AFTER DELETE ON cars BEGIN
+               {_count_facet('old', -1)}
+           END''',
+        'DELETE FROM car_facets',
+        f'''INSERT INTO car_facets ({', '.join(FACET_KEY)}, count)
+           SELECT {facet_values('cars')}, COUNT(*) FROM cars
+           WHERE status = 'approved'
+           GROUP BY 1, 2, 3, 4, 5, 6''',
+    ]),
+    # Per-car counters kept on the row instead of counted per request. The
+    # favorite count moves in the same transaction as the favorites row;
+    # views are added in batches by the app. Neither bumps the content
+    # versions, so a view never invalidates a cached listing.
+    (11, 'favorite and view counters on cars', [
+        'ALTER TABLE cars ADD COLUMN favorite_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE cars ADD COLUMN view_count INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS idx_cars_status_popularity ON cars (status, favorite_count)',
+        'DROP TRIGGER IF EXISTS cars_versions_update',
+        f'''CREATE TRIGGER cars_versions_update
+           AFTER UPDATE OF {', '.join(CAR_CONTENT_COLUMNS)} ON cars BEGIN
+               {_CARS_UPDATE_BUMPS}
+           END''',
+        # The car page shows the count, and so do listings that sort by it
+        # or ask for it; those also depend on 'car-counters', so ordinary
+        # listings keep their ETags when someone favorites a car
+        f'''CREATE TRIGGER IF NOT EXISTS cars_favorite_count_versions
+           AFTER UPDATE OF favorite_count ON cars BEGIN
+               {_bump('car-counters', '0', "new.status = 'approved'")}
+               {_bump('car', 'new.id')}
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS favorites_count_insert AFTER INSERT ON favorites BEGIN
+               UPDATE cars SET favorite_count = favorite_count + 1 WHERE id = new.car_id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS favorites_count_delete AFTER DELETE ON favorites BEGIN
+               UPDATE cars SET favorite_count = favorite_count - 1 WHERE id = old.car_id;
+           END''',
+        '''UPDATE cars SET favorite_count = (SELECT COUNT(*) FROM favorites WHERE car_id = cars.id)''',
+    ]),
+    # Daily view and impression rollups, written in batches by the app's
+    # view counter. The per-seller rollup follows the per-car one, so seller
+    # stats are one range read. A deleted car's days go with it; the seller's
+    # history keeps them.
+    (12, 'daily view and impression rollups', [
+        '''CREATE TABLE IF NOT EXISTS car_daily_stats
+           (car_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            views INTEGER NOT NULL DEFAULT 0,
+            impressions INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (car_id, day)) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS seller_daily_stats
+           (user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            views INTEGER NOT NULL DEFAULT 0,
+            impressions INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)) WITHOUT ROWID''',
+        f'''CREATE TRIGGER IF NOT EXISTS car_daily_stats_seller_insert AFTER INSERT ON car_daily_stats BEGIN
+               {_add_seller_stats('new.views', 'new.impressions')}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS car_daily_stats_seller_update AFTER UPDATE ON car_daily_stats BEGIN
+               {_add_seller_stats('new.views - old.views', 'new.impressions - old.impressions')}
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS cars_daily_stats_delete AFTER DELETE ON cars BEGIN
+               DELETE FROM car_daily_stats WHERE car_id = old.id;
+           END''',
+    ]),
+]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    # Applies pending migrations, each in its own transaction. BEGIN IMMEDIATE
+    # takes the write lock up front so concurrent workers starting at the same
+    # time apply each migration exactly once.
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        applied.append((version, description))
+    return applied
+
+
+# Representative statements for each route's hot query. Keep these in step
+# with the SQL in app.py; check_query_plans() fails if any of them has to
+# fall back to a full table scan. Listing searches and facets are not copied
+# here: app.listing_plan_checks() builds them through search.py and
+# facets.py, and tests/test_query_plans.py checks every shape and the SQL
+# the routes actually run.
+QUERY_PLAN_CHECKS = [
+    ('my-cars', """
+        SELECT c.* FROM cars c
+        WHERE c.user_id = ?
+        ORDER BY c.created_at DESC
+    """, (1,)),
+    ('car stats', """
+        SELECT day, views, impressions FROM car_daily_stats
+        WHERE car_id = ? AND day >= ? ORDER BY day
+    """, (1, '2024-01-01')),
+    ('seller stats', """
+        SELECT day, views, impressions FROM seller_daily_stats
+        WHERE user_id = ? AND day >= ? ORDER BY day
+    """, (1, '2024-01-01')),
+    ('seller stats: per listing', """
+        SELECT s.car_id, SUM(s.views), SUM(s.impressions)
+        FROM cars c JOIN car_daily_stats s ON s.car_id = c.id
+        WHERE c.user_id = ? AND s.day >= ?
+        GROUP BY s.car_id
+    """, (1, '2024-01-01')),
+    ('favorites', """
+        SELECT c.*, f.created_at as favorited_at
+        FROM cars c
+        JOIN favorites f ON c.id = f.car_id
+        WHERE f.user_id = ? AND c.status = 'approved'
+        ORDER BY f.created_at DESC
+    """, (1,)),
+    ('favorites: batch check', """
+        SELECT car_id FROM favorites WHERE user_id = ? AND car_id IN (?, ?, ?)
+    """, (1, 1, 2, 3)),
+    ('messages: inbox', """
+        SELECT cv.other_user_id, u.firstName, u.lastName, c.make, c.model, c.year,
+               cv.last_message_time, cv.unread_count, cv.last_message_preview
+        FROM conversations cv
+        JOIN users u ON u.id = cv.other_user_id
+        LEFT JOIN cars c ON c.id = cv.car_id
+        WHERE cv.user_id = ?
+        ORDER BY cv.last_message_id DESC
+    """, (1,)),
+    ('messages: conversation page', """
+        SELECT m.* FROM (
+            SELECT id FROM (SELECT id FROM messages
+                            WHERE sender_id = ? AND receiver_id = ? AND id < ?
+                            ORDER BY id DESC LIMIT 51)
+            UNION
+            SELECT id FROM (SELECT id FROM messages
+                            WHERE sender_id = ? AND receiver_id = ? AND id < ?
+                            ORDER BY id DESC LIMIT 51)
+            ORDER BY id DESC LIMIT 51
+        ) p
+        JOIN messages m ON m.id = p.id
+        JOIN users s ON s.id = m.sender_id
+        JOIN users r ON r.id = m.receiver_id
+        ORDER BY m.id ASC
+    """, (1, 2, 1000, 2, 1, 1000)),
+    ('messages: mark read', """
+        UPDATE messages SET read = 1
+        WHERE receiver_id = ? AND sender_id = ? AND read = 0
+    """, (1, 2)),
+    ('cars: photos for a page', """
+        SELECT group_concat(photo_path, ',') FROM (
+            SELECT photo_path FROM car_photos WHERE car_id = ?
+            ORDER BY position, id)
+    """, (1,)),
+    ('cars: export own listings', """
+        SELECT * FROM cars WHERE id > ? AND user_id = ? ORDER BY id LIMIT 500
+    """, (0, 1)),
+    ('cars: export all listings', """
+        SELECT * FROM cars WHERE id > ? ORDER BY id LIMIT 500
+    """, (0,)),
+    ('admin: moderation queue page', """
+        SELECT c.*, u.firstName, u.lastName, u.email, u.phone
+        FROM cars c
+        LEFT JOIN users u ON c.user_id = u.id
+        WHERE c.status = ? AND c.created_at >= ? AND (c.created_at > ? OR c.id > ?)
+        ORDER BY c.created_at ASC, c.id ASC LIMIT 51
+    """, ('pending', '2024-01-01', '2024-01-01', 10)),
+    ('admin: cars by status', """
+        SELECT c.*, u.firstName, u.lastName, u.email, u.phone
+        FROM cars c
+        JOIN users u ON c.user_id = u.id
+        WHERE c.status = ?
+        ORDER BY c.created_at DESC
+    """, ('pending',)),
+]
+
+
+# Trigger-maintained summaries that are small by construction (one row per
+# status, one per facet combination) and are meant to be read whole
+WHOLE_TABLE_READS = ('car_status_counts', 'car_facets')
+
+
+def full_scans(plan):
+    # Only SEARCH narrows to a range: "SCAN cars" reads the whole table and
+    # "SCAN cars USING [COVERING] INDEX ..." the whole index. Scans of
+    # materialized subqueries and co-routines read temporary results.
+    derived = {detail.split(' ', 1)[1] for detail in plan
+               if detail.startswith(('MATERIALIZE ', 'CO-ROUTINE '))}
+    scans = []
+    for detail in plan:
+        if not detail.startswith('SCAN ') or 'CONSTANT ROW' in detail or 'VIRTUAL TABLE' in detail:
+            continue
+        target = detail[len('SCAN '):].split(' USING ', 1)[0]
+        if target in derived or target.startswith('(subquery') or target in WHOLE_TABLE_READS:
+            continue
+        scans.append(detail)
+    return scans
+
+
+def check_query_plans(conn, checks=QUERY_PLAN_CHECKS):
+    failures = []
+    for name, sql, params in checks:
+        plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+        scans = full_scans(plan)
+        if scans:
+            failures.append((name, scans))
+    return failures
@@ -0,0 +1,138 @@
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Werkzeug method string; the scrypt N (or PBKDF2 iteration count) is the
+# cost knob. Stored hashes made with another method are upgraded on login.
+PASSWORD_METHOD = os.environ.get('MAWATER_PASSWORD_METHOD', 'scrypt:32768:8:1')
+SALT_LENGTH = 16
+# 0 hashes in the calling thread (tests, single-process tools)
+HASH_WORKERS = int(os.environ.get('MAWATER_HASH_WORKERS', str(os.cpu_count() or 1)))
+HASH_QUEUE_SIZE = int(os.environ.get('MAWATER_HASH_QUEUE_SIZE', str(max(HASH_WORKERS, 1) * 8)))
+HASH_TIMEOUT = float(os.environ.get('MAWATER_HASH_TIMEOUT', '5'))
+
+HASH_PREFIXES = ('scrypt:', 'pbkdf2:')
+
+BENCHMARK_METHODS = (
+    'pbkdf2:sha256:100000',
+    'pbkdf2:sha256:600000',
+    'scrypt:16384:8:1',
+    'scrypt:32768:8:1',
+    'scrypt:65536:8:1',
+)
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def is_hashed(stored):
+    return stored.startswith(HASH_PREFIXES) and stored.count('$') == 2
+
+
+def needs_rehash(stored, method=PASSWORD_METHOD):
+    # Plaintext rows from before hashing, or hashes made at another cost
+    return not is_hashed(stored) or stored.split('$', 1)[0] != method
+
+
+# Run inside the worker processes
+def _hash(password, method):
+    return generate_password_hash(password, method=method, salt_length=SALT_LENGTH)
+
+
+def _verify(stored, password):
+    if is_hashed(stored):
+        return check_password_hash(stored, password)
+    return hmac.compare_digest(stored.encode(), password.encode())
+
+
+class HashPool:
+    # Slow hashes run in worker processes so they neither hold the GIL nor
+    # tie up more request threads than there are cores. At most queue_size
+    # calls wait at once; beyond that callers get HashingBusy rather than
+    # piling up behind a login burst.
+
+    def __init__(self, workers=HASH_WORKERS, queue_size=HASH_QUEUE_SIZE, timeout=HASH_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+        self._executor = None
+        self.completed = 0
+        self.rejected = 0
+        self._busy_time = 0.0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a process that is already running request
+                # threads can copy locks held by those threads
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.rejected += 1
+            raise HashingBusy('Too many logins in progress, please retry')
+        start = time.perf_counter()
+        try:
+            if self.workers <= 0:
+                return fn(*args)
+            return self._get_executor().submit(fn, *args).result(timeout=self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self.rejected += 1
+            raise HashingBusy('Password check timed out, please retry')
+        finally:
+            self._slots.release()
+            with self._lock:
+                self.completed += 1
+                self._busy_time += time.perf_counter() - start
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'method': PASSWORD_METHOD,
+                'workers': self.workers,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'avg_ms': round(self._busy_time * 1000 / self.completed, 3) if self.completed else 0.0,
+            }
+
+
+pool = HashPool()
+
+
+def hash_password(password):
+    return pool.run(_hash, password, PASSWORD_METHOD)
+
+
+def verify_password(stored, password):
+    return pool.run(_verify, stored, password)
+
+
+def benchmark(methods=BENCHMARK_METHODS, rounds=5):
+    # Single-core verifications per second for each cost setting; a login
+    # costs one verification, so this is logins/second per core
+    results = []
+    for method in methods:
+        stored = _hash('benchmark-password', method)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            _verify(stored, 'benchmark-password')
+        per_login = (time.perf_counter() - start) / rounds
+        results.append((method, per_login * 1000, 1 / per_login))
+    return results
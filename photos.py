@@ -0,0 +1,225 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Request
+
+try:
+    from PIL import Image
+except ImportError:  # optional; without it thumbnail URLs serve the original
+    Image = None
+
+PHOTO_DIR = os.path.abspath(os.environ.get('MAWATER_PHOTO_DIR', 'uploads'))
+MAX_UPLOAD_BYTES = int(os.environ.get('MAWATER_MAX_UPLOAD_BYTES', str(64 * 1024 * 1024)))
+THUMBNAIL_WORKERS = int(os.environ.get('MAWATER_THUMBNAIL_WORKERS', '2'))
+THUMBNAIL_SIZE = (480, 360)
+THUMBNAIL_QUALITY = 80
+MAX_PHOTOS_PER_CAR = 20
+
+# Stored files are named after the SHA-256 of their content, so a name always
+# refers to the same bytes and can be cached by clients forever
+CACHE_MAX_AGE = 365 * 24 * 3600
+
+IMAGE_EXTENSIONS = {
+    'jpg': 'jpg', 'jpeg': 'jpg', 'png': 'png', 'gif': 'gif', 'webp': 'webp',
+}
+PHOTO_NAME = re.compile(r'^[0-9a-f]{64}\.(jpg|png|gif|webp)$')
+# Leading bytes of each stored type (WebP is RIFF....WEBP). A file is stored
+# under the type its content has, whatever the upload was called.
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+PILLOW_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+
+class InvalidPhoto(ValueError):
+    pass
+
+
+def originals_dir():
+    return os.path.join(PHOTO_DIR, 'originals')
+
+
+def thumbnails_dir():
+    return os.path.join(PHOTO_DIR, 'thumbnails')
+
+
+def staging_dir():
+    path = os.path.join(PHOTO_DIR, 'staging')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def sharded(name):
+    # Two-character fan-out keeps directories small
+    return f'{name[:2]}/{name}'
+
+
+def thumbnail_name(photo_name):
+    return photo_name.rsplit('.', 1)[0] + '.jpg'
+
+
+class HashingFile:
+    # Upload target handed to Werkzeug's multipart parser. Chunks are written
+    # straight to a staging file on the same filesystem as the photo store and
+    # hashed as they arrive, so neither buffering nor a second pass is needed.
+
+    def __init__(self, directory):
+        self._file = tempfile.NamedTemporaryFile(dir=directory, prefix='upload-', delete=False)
+        self.name = self._file.name
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.committed = False
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        if not self.committed:
+            try:
+                os.unlink(self.name)
+            except FileNotFoundError:
+                pass
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        return HashingFile(staging_dir())
+
+
+def _extension(upload):
+    filename = upload.filename or ''
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext not in IMAGE_EXTENSIONS and upload.mimetype.startswith('image/'):
+        ext = upload.mimetype.split('/', 1)[1].lower()
+    if ext not in IMAGE_EXTENSIONS:
+        raise InvalidPhoto(f'Unsupported photo type: {upload.filename or upload.mimetype}')
+    return IMAGE_EXTENSIONS[ext]
+
+
+def _content_type(path):
+    # The stored extension for the image in path, checked with Pillow when it
+    # is installed and by signature otherwise
+    with open(path, 'rb') as f:
+        head = f.read(12)
+    ext = next((ext for signature, ext in SIGNATURES if head.startswith(signature)), None)
+    if ext is None and head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        ext = 'webp'
+    if Image is not None:
+        try:
+            with Image.open(path) as image:
+                image.verify()
+                ext = PILLOW_FORMATS.get(image.format)
+        except Exception:
+            ext = None
+    return ext
+
+
+def store_upload(upload):
+    # Moves an uploaded file into the content-addressed store and returns its
+    # name. Identical uploads map to the same name and are stored once.
+    # Rejects uploads that do not even claim to be images
+    _extension(upload)
+    stream = upload.stream
+    if not isinstance(stream, HashingFile):
+        # Not parsed by UploadRequest; copy it through a staging file
+        stream = HashingFile(staging_dir())
+        upload.save(stream)
+    if stream.size == 0:
+        stream.close()
+        raise InvalidPhoto(f'Empty photo: {upload.filename}')
+    stream.flush()
+    ext = _content_type(stream.name)
+    if ext is None:
+        stream.close()
+        raise InvalidPhoto(f'Not a JPEG, PNG, GIF or WebP image: {upload.filename}')
+    name = f'{stream.hexdigest()}.{ext}'
+    target = os.path.join(originals_dir(), sharded(name))
+    if not os.path.exists(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(stream.name, target)
+        stream.committed = True
+    stream.close()
+    return name
+
+
+def _make_thumbnail(name):
+    target = os.path.join(thumbnails_dir(), sharded(thumbnail_name(name)))
+    if os.path.exists(target):
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with Image.open(os.path.join(originals_dir(), sharded(name))) as image:
+        image.thumbnail(THUMBNAIL_SIZE)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(target), suffix='.jpg',
+                                         delete=False) as tmp:
+            try:
+                image.save(tmp, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+            except Exception:
+                os.unlink(tmp.name)
+                raise
+    os.replace(tmp.name, target)
+
+
+class ThumbnailWorker:
+    # Resizes photos off the request thread. Until a thumbnail exists its URL
+    # serves the original, so listings never wait on (or change after) it.
+
+    def __init__(self, workers=THUMBNAIL_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.generated = 0
+        self.failed = 0
+
+    def submit(self, name):
+        if Image is None:
+            return
+        with self._lock:
+            if name in self._pending:
+                return
+            self._pending.add(name)
+        self._executor.submit(self._run, name)
+
+    def _run(self, name):
+        try:
+            _make_thumbnail(name)
+            with self._lock:
+                self.generated += 1
+        except Exception as e:
+            print(f"Error generating thumbnail for {name}: {str(e)}")
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': Image is not None,
+                'pending': len(self._pending),
+                'generated': self.generated,
+                'failed': self.failed,
+            }
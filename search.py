@@ -0,0 +1,169 @@
+import functools
+import math
+import os
+
+# Listing filters in the order their conditions appear in the statement.
+# Numeric bounds are parsed to the column's type, so a malformed bound is a
+# 400 instead of a comparison against text, and 2010 and 2010.0 share a
+# cache entry.
+FILTERS = (
+    ('make', str, 'make LIKE ?'),
+    ('model', str, 'model LIKE ?'),
+    ('year_min', int, 'year >= ?'),
+    ('year_max', int, 'year <= ?'),
+    ('price_min', float, 'price >= ?'),
+    ('price_max', float, 'price <= ?'),
+    ('mileage_min', int, 'mileage >= ?'),
+    ('mileage_max', int, 'mileage <= ?'),
+    ('condition', str, 'condition = ?'),
+)
+LIKE_FILTERS = ('make', 'model')
+LISTING_FILTERS = tuple(name for name, _, _ in FILTERS) + ('q',)
+
+# Whitelisted sort keys, each backed by a (status, key) index (relevance
+# ranks FTS matches). Mileage is optional, so missing values sort as 0 to
+# keep the keyset total. Popularity is the maintained favorite count.
+SORT_KEYS = {
+    'created_at': 'cars.created_at',
+    'price': 'cars.price',
+    'year': 'cars.year',
+    'mileage': 'IFNULL(cars.mileage, 0)',
+    'popularity': 'cars.favorite_count',
+    'relevance': 'm.score',
+}
+SORT_ORDERS = ('ASC', 'DESC')
+
+# Distinct statement shapes kept built. A shape is the set of filters
+# present, sort, order, search, favorites, page and columns; its SQL text is
+# built once and the same string reused, so the connection's prepared
+# statement cache (db.STATEMENT_CACHE_SIZE) finds it again.
+SHAPE_CACHE_SIZE = int(os.environ.get('MAWATER_SEARCH_SHAPES', '1024'))
+
+# Free-text search drives the query from the FTS index, joined to cars by
+# primary key, and exposes the BM25 score for ranking. CROSS JOIN pins that
+# order: left to the planner, a count may scan a covering status index and
+# probe the FTS table once per approved car instead.
+_FTS_SOURCE = """(
+    SELECT rowid AS fts_id, bm25(cars_fts, 10.0, 10.0, 1.0) AS score
+    FROM cars_fts WHERE cars_fts MATCH ?
+) m CROSS JOIN cars ON cars.id = m.fts_id"""
+
+
+class InvalidSearch(ValueError):
+    pass
+
+
+def _number(name, kind, value):
+    try:
+        number = kind(value)
+    except ValueError:
+        raise InvalidSearch(f"{name} must be {'a whole number' if kind is int else 'a number'}")
+    if not math.isfinite(number):
+        raise InvalidSearch(f'{name} must be a number')
+    return number
+
+
+def parse_filters(args):
+    # The listing filters in a query string; blank values are dropped
+    filters = {}
+    for name, kind, _ in FILTERS:
+        value = args.get(name, '').strip()
+        if value:
+            filters[name] = value if kind is str else _number(name, kind, value)
+    q = args.get('q', '').strip()
+    if q:
+        filters['q'] = q
+    return filters
+
+
+def parse_sort(args, searching):
+    sort_by = args.get('sort_by') or ('relevance' if searching else 'created_at')
+    sort_order = args.get('sort_order', 'DESC').upper()
+    if sort_by not in SORT_KEYS:
+        raise InvalidSearch(f"Invalid sort_by. Must be one of: {', '.join(SORT_KEYS)}")
+    if sort_order not in SORT_ORDERS:
+        raise InvalidSearch('Invalid sort_order. Must be ASC or DESC')
+    if sort_by == 'relevance':
+        if not searching:
+            raise InvalidSearch('sort_by=relevance requires a search query (q)')
+        # Best BM25 match first, regardless of the requested order
+        sort_order = 'ASC'
+    return sort_by, sort_order
+
+
+def _present(filters):
+    return tuple(name for name, _, _ in FILTERS if name in filters)
+
+
+def _where(present):
+    conditions = ["status = 'approved'"]
+    conditions += [condition for name, _, condition in FILTERS if name in present]
+    return 'WHERE ' + ' AND '.join(conditions)
+
+
+def _where_params(filters):
+    return [f'%{filters[name]}%' if name in LIKE_FILTERS else filters[name] for name in _present(filters)]
+
+
+@functools.lru_cache(maxsize=SHAPE_CACHE_SIZE)
+def _count_statement(present, searching):
+    return f"SELECT COUNT(*) FROM {_FTS_SOURCE if searching else 'cars'} {_where(present)}"
+
+
+@functools.lru_cache(maxsize=SHAPE_CACHE_SIZE)
+def _page_statement(present, sort_by, sort_order, searching, favorites, paged, columns):
+    sort_expr = SORT_KEYS[sort_by]
+    source = _FTS_SOURCE if searching else 'cars'
+    if favorites:
+        # favorites is unique on (user_id, car_id), so this is one index
+        # probe per returned row and never multiplies rows
+        sql = (f"SELECT {columns}, {sort_expr}, f.id IS NOT NULL FROM {source} "
+               f"LEFT JOIN favorites f ON f.car_id = cars.id AND f.user_id = ? {_where(present)}")
+    else:
+        sql = f"SELECT {columns}, {sort_expr} FROM {source} {_where(present)}"
+    if paged:
+        # Keyset pagination: seek past the last (sort key, id) seen. The
+        # inclusive bound lets SQLite range-scan the (status, key) index.
+        op, tie = ('<', '<=') if sort_order == 'DESC' else ('>', '>=')
+        sql += f" AND {sort_expr} {tie} ? AND ({sort_expr} {op} ? OR cars.id {op} ?)"
+    return sql + f" ORDER BY {sort_expr} {sort_order}, cars.id {sort_order} LIMIT ?"
+
+
+def count_query(filters, fts_query=None):
+    params = ([fts_query] if fts_query else []) + _where_params(filters)
+    return _count_statement(_present(filters), bool(fts_query)), params
+
+
+def page_query(filters, sort_by, sort_order, columns, limit, fts_query=None, favorites_for=None,
+               position=None):
+    # (sql, params) for one page of listings. Rows are the columns asked for,
+    # then the sort value, then the is_favorite flag when favorites_for is set.
+    # Only whitelisted sort keys and orders reach the SQL; everything from the
+    # request is a parameter.
+    if sort_by not in SORT_KEYS or sort_order not in SORT_ORDERS:
+        raise InvalidSearch('Invalid sort')
+    sql = _page_statement(_present(filters), sort_by, sort_order, bool(fts_query),
+                          favorites_for is not None, position is not None, columns)
+    params = [fts_query] if fts_query else []
+    if favorites_for is not None:
+        params.append(favorites_for)
+    params += _where_params(filters)
+    if position is not None:
+        params += [position['v'], position['v'], position['id']]
+    params.append(limit + 1)
+    return sql, params
+
+
+def stats():
+    result = {}
+    for name, statement in (('page', _page_statement), ('count', _count_statement)):
+        info = statement.cache_info()
+        lookups = info.hits + info.misses
+        result[name] = {
+            'shapes': info.currsize,
+            'max_shapes': info.maxsize,
+            'hits': info.hits,
+            'misses': info.misses,
+            'hit_rate': round(info.hits / lookups, 4) if lookups else 0.0,
+        }
+    return result
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# db.py reads the database path at import, so point the app at a scratch
+# directory before any test module imports it
+_scratch = tempfile.mkdtemp(prefix='mawater-tests-')
+os.environ['MAWATER_DB'] = os.path.join(_scratch, 'mawater.db')
+os.environ['MAWATER_PHOTO_DIR'] = os.path.join(_scratch, 'uploads')
+os.environ['MAWATER_HASH_WORKERS'] = '0'
+os.environ['MAWATER_ANALYTICS_FLUSH_SECONDS'] = '0'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
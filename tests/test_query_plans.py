@@ -0,0 +1,160 @@
+import itertools
+import random
+
+import pytest
+
+import auth
+import db
+import facets
+import loadtest
+import metrics
+import migrations
+import projection
+import search
+
+SIZES = {'users': 200, 'cars': 2000, 'messages': 5000, 'favorites': 2000}
+
+# A value for every listing filter, and the combinations searched with
+FILTER_VALUES = {
+    'make': 'Toyota', 'model': 'Corolla', 'year_min': 2010, 'year_max': 2020,
+    'price_min': 1000.0, 'price_max': 50000.0, 'mileage_min': 0, 'mileage_max': 100000,
+    'condition': 'good',
+}
+FILTER_SETS = [
+    (), ('make',), ('model',), ('make', 'model'), ('year_min', 'year_max'),
+    ('price_min', 'price_max'), ('mileage_min', 'mileage_max'), ('condition',),
+    tuple(FILTER_VALUES),
+]
+FTS_QUERY = '"toy"*'
+
+
+@pytest.fixture(scope='module')
+def app():
+    # The benchmark seeder builds the current schema, fills it through the
+    # triggers and runs ANALYZE, so plans are chosen on real statistics
+    loadtest.seed(db.DATABASE, SIZES, progress=lambda message: None)
+    import app as appmod
+    flask_app = appmod.create_app()
+    yield flask_app
+    appmod.shutdown()
+
+
+@pytest.fixture
+def conn(app):
+    conn = db.connect()
+    yield conn
+    conn.close()
+
+
+def plan_scans(conn, sql, params):
+    plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+    return migrations.full_scans(plan)
+
+
+def test_full_scans_counts_whole_index_walks():
+    assert migrations.full_scans([
+        'SEARCH cars USING INDEX idx_cars_status_created (status=?)',
+        'SEARCH f USING COVERING INDEX sqlite_autoindex_favorites_1 (user_id=? AND car_id=?)',
+        'SCAN car_facets',
+        'SCAN car_status_counts USING INDEX sqlite_autoindex_car_status_counts_1',
+        'SCAN cars_fts VIRTUAL TABLE INDEX 0:M3',
+        'SCAN (subquery-1)',
+    ]) == []
+    walks = [
+        'SCAN cars USING INDEX idx_cars_status_created',
+        'SCAN c USING COVERING INDEX idx_cars_user',
+        'SCAN messages',
+    ]
+    assert migrations.full_scans(walks) == walks
+
+
+def listing_statements():
+    import app as appmod
+    columns = projection.select_list(projection.CARD_FIELDS, 'cars', appmod.photos_column('cars.id'))
+    for names in FILTER_SETS:
+        filters = {name: FILTER_VALUES[name] for name in names}
+        for fts_query in (None, FTS_QUERY):
+            yield ('count', names, fts_query), search.count_query(filters, fts_query)
+            for sort_by, sort_order, favorites_for, position in itertools.product(
+                    search.SORT_KEYS, search.SORT_ORDERS, (None, 1), (None, {'v': 5, 'id': 100})):
+                if sort_by == 'relevance' and not fts_query:
+                    continue
+                yield ((sort_by, sort_order, names, fts_query, favorites_for, position),
+                       search.page_query(filters, sort_by, sort_order, columns, 20, fts_query,
+                                         favorites_for, position))
+
+
+def test_listing_statements_use_indexes(conn):
+    failures = [(shape, scans) for shape, statement in listing_statements()
+                if (scans := plan_scans(conn, *statement))]
+    assert not failures
+
+
+def test_facet_statements_use_indexes(conn):
+    failures = []
+    for names in FILTER_SETS:
+        filters = {name: FILTER_VALUES[name] for name in names}
+        for fts_query in (None, FTS_QUERY):
+            scans = plan_scans(conn, *facets.facet_query(filters, fts_query))
+            if scans:
+                failures.append((names, fts_query, scans))
+    assert not failures
+
+
+def test_plan_check_command_statements_use_indexes(app, conn):
+    import app as appmod
+    checks = migrations.QUERY_PLAN_CHECKS + appmod.listing_plan_checks()
+    assert not migrations.check_query_plans(conn, checks)
+
+
+def bearer(app, user_id):
+    with app.app_context():
+        return {'Authorization': f'Bearer {auth.issue_token(user_id)}'}
+
+
+def route_paths(app, client, ctx, rng):
+    # Every read scenario the load test drives, plus second pages and the
+    # routes it leaves out, each with the user it is requested as
+    seller, admin = ctx.sellers[0], ctx.admin_id
+    for name in loadtest.READ_SCENARIOS:
+        for _ in range(10):
+            call = loadtest.SCENARIOS[name](rng, ctx)
+            yield (call, seller) if isinstance(call, str) else (call[1], call[3])
+    for sort_by in ('created_at', 'price', 'year', 'mileage', 'popularity'):
+        page = client.get(f'/api/cars?sort_by={sort_by}&limit=5').get_json()
+        yield f"/api/cars?sort_by={sort_by}&limit=5&cursor={page['next_cursor']}", seller
+    user_id, other_id = ctx.conversations[0]
+    page = client.get(f'/api/messages/{other_id}?limit=2', headers=bearer(app, user_id)).get_json()
+    yield f"/api/messages/{other_id}?before={page['messages'][0]['id']}", user_id
+    yield f'/api/cars/{ctx.cars[0]}/stats', admin
+    yield '/api/my-cars/stats', seller
+    yield '/api/cars/export', seller
+    yield '/api/cars/export?format=csv', admin
+    yield '/api/admin/queue?status=pending&limit=5', admin
+
+
+def test_route_statements_use_indexes(app, conn, monkeypatch):
+    # The statements the routes actually run, captured from the instrumented
+    # connections, so nothing here is a copy of the SQL in app.py
+    statements = {}
+    observe = metrics._observe
+
+    def capture(cursor, sql, params, seconds, plan=True):
+        statements.setdefault(sql, params)
+        return observe(cursor, sql, params, seconds, plan)
+
+    ctx = loadtest.Context(conn)
+    client = app.test_client()
+    monkeypatch.setattr(metrics, '_observe', capture)
+    for path, user_id in route_paths(app, client, ctx, random.Random(0)):
+        response = client.get(path, headers=bearer(app, user_id))
+        assert response.status_code == 200, (path, response.get_data(as_text=True))
+        response.close()
+    monkeypatch.undo()
+
+    reads = {sql: params for sql, params in statements.items()
+             if sql.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE'))}
+    assert len(reads) > 20
+    failures = [(' '.join(sql.split()), scans) for sql, params in reads.items()
+                if (scans := plan_scans(conn, sql, params))]
+    assert not failures
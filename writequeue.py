@@ -0,0 +1,243 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import db
+
+# 0 runs each write in its own transaction on the calling thread, as before
+ENABLED = os.environ.get('MAWATER_WRITE_QUEUE', '1') == '1'
+# How long the writer lingers after the first queued write to gather more
+# into the same transaction
+FLUSH_INTERVAL = float(os.environ.get('MAWATER_WRITE_FLUSH_MS', '2')) / 1000
+MAX_BATCH = int(os.environ.get('MAWATER_WRITE_MAX_BATCH', '500'))
+MAX_PENDING = int(os.environ.get('MAWATER_WRITE_MAX_PENDING', '10000'))
+WRITE_TIMEOUT = float(os.environ.get('MAWATER_WRITE_TIMEOUT', '5'))
+
+
+class WriteQueueFull(Exception):
+    pass
+
+
+class WriteTimeout(Exception):
+    # The write was queued but not committed in time; it is still queued and
+    # may yet apply
+    pass
+
+
+class Write:
+    __slots__ = ('sql', 'params', 'user_id', 'on_commit', 'future')
+
+    def __init__(self, sql, params, user_id, on_commit):
+        self.sql = sql
+        self.params = params
+        self.user_id = user_id
+        self.on_commit = on_commit
+        self.future = Future()
+
+
+class WriteQueue:
+    # One writer thread drains queued single-statement writes and commits
+    # them together: one BEGIN IMMEDIATE ... COMMIT per batch instead of per
+    # click, and no request threads contending for the write lock. Each write
+    # runs in its own savepoint, so one failing (e.g. a duplicate favorite)
+    # does not undo the others. Callers either wait for the commit (execute)
+    # or queue and move on (submit); wait_for() gives a user's later reads
+    # their own writes.
+
+    def __init__(self, enabled=ENABLED, flush_interval=FLUSH_INTERVAL, max_batch=MAX_BATCH,
+                 max_pending=MAX_PENDING, timeout=WRITE_TIMEOUT):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._queue = queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        self._committed = threading.Condition(self._lock)
+        self._pending_by_user = defaultdict(int)
+        self._thread = None
+        self._closed = False
+        self.submitted = 0
+        self.committed = 0
+        self.failed = 0
+        self.batches = 0
+        self.batched_writes = 0
+        self.max_batch_seen = 0
+        self._commit_time = 0.0
+
+    def _start(self):
+        # Started on first use, so a server forking workers after import
+        # gets one writer per worker
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-queue', daemon=True)
+                self._thread.start()
+
+    def submit(self, sql, params=(), user_id=None, on_commit=None):
+        # Queues a write and returns a Future of its rowcount. on_commit runs
+        # on the writer thread once the write is durable.
+        write = Write(sql, params, user_id, on_commit)
+        if not self.enabled or self._closed:
+            self._commit([write], inline=True)
+            return write.future
+        if self._thread is None:
+            self._start()
+        with self._lock:
+            self.submitted += 1
+            if user_id is not None:
+                self._pending_by_user[user_id] += 1
+        try:
+            self._queue.put(write, timeout=self.timeout)
+        except queue.Full:
+            self._finish(write)
+            raise WriteQueueFull('Too many writes queued, please retry')
+        return write.future
+
+    def execute(self, sql, params=(), user_id=None, on_commit=None):
+        # Queues a write and waits for the batch holding it to commit
+        future = self.submit(sql, params, user_id, on_commit)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            raise WriteTimeout(f'Write not committed within {self.timeout:g}s')
+
+    def wait_for(self, user_id, timeout=None):
+        # Blocks until every write queued for user_id has committed
+        if user_id is None or not self._pending_by_user:
+            return True
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        with self._lock:
+            while self._pending_by_user.get(user_id):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._committed.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            write = self._queue.get()
+            if write is None:
+                return
+            batch = [write]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    write = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if write is None:
+                    self._queue.put(None)
+                    break
+                batch.append(write)
+            self._commit(batch)
+
+    def _connection(self):
+        conn = getattr(self, '_conn', None)
+        if conn is None:
+            conn = self._conn = db.connect()
+        return conn
+
+    def _commit(self, batch, inline=False):
+        start = time.perf_counter()
+        results = []
+        try:
+            if inline:
+                with db.pooled_connection() as conn:
+                    results = self._apply(conn, batch)
+            else:
+                results = self._apply(self._connection(), batch)
+        except Exception as e:
+            # The transaction itself failed (e.g. the write lock timed out)
+            print(f"Error committing {len(batch)} queued writes: {str(e)}")
+            results = [e] * len(batch)
+        elapsed = time.perf_counter() - start
+
+        # Callbacks (cache invalidation, notifications) first, then release
+        # readers waiting in wait_for(), then the writers themselves
+        for write, result in zip(batch, results):
+            if write.on_commit is not None and not isinstance(result, Exception):
+                try:
+                    write.on_commit(result)
+                except Exception as e:
+                    print(f"Error in write commit callback: {str(e)}")
+        with self._lock:
+            if not inline:
+                self.batches += 1
+                self.batched_writes += len(batch)
+                self.max_batch_seen = max(self.max_batch_seen, len(batch))
+                self._commit_time += elapsed
+            for write, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self.failed += 1
+                else:
+                    self.committed += 1
+                if not inline:
+                    self._finish(write, locked=True)
+            self._committed.notify_all()
+        for write, result in zip(batch, results):
+            if isinstance(result, Exception):
+                write.future.set_exception(result)
+            else:
+                write.future.set_result(result)
+
+    def _finish(self, write, locked=False):
+        if write.user_id is None:
+            return
+        if not locked:
+            with self._lock:
+                return self._finish(write, locked=True)
+        self._pending_by_user[write.user_id] -= 1
+        if self._pending_by_user[write.user_id] <= 0:
+            del self._pending_by_user[write.user_id]
+
+    @staticmethod
+    def _apply(conn, batch):
+        results = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for write in batch:
+                conn.execute('SAVEPOINT write')
+                try:
+                    results.append(conn.execute(write.sql, write.params).rowcount)
+                    conn.execute('RELEASE write')
+                except sqlite3.Error as e:
+                    conn.execute('ROLLBACK TO write')
+                    conn.execute('RELEASE write')
+                    results.append(e)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        return results
+
+    def close(self):
+        # Commits what is queued, then stops the writer
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(self.timeout)
+        conn = getattr(self, '_conn', None)
+        if conn is not None:
+            conn.close()
+            self._conn = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'queued': self._queue.qsize(),
+                'submitted': self.submitted,
+                'committed': self.committed,
+                'failed': self.failed,
+                'batches': self.batches,
+                'avg_batch_size': round(self.batched_writes / self.batches, 2) if self.batches else 0.0,
+                'max_batch_size': self.max_batch_seen,
+                'avg_commit_ms': round(self._commit_time * 1000 / self.batches, 3) if self.batches else 0.0,
+            }